@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import json
+import urllib
+import urllib2
+
+from ratelimit import get_rate_limiter, parse_retry_after
+from transport import get_transport
+
+__all__ = ['API_BATCH_SIZE', 'WikimediaApiError', 'get_api_url', 'request_api', 'query_revisions', 'get_batches',
+           'fetch_pages', 'get_recent_changes', 'iter_recent_changes']
+
+API_BATCH_SIZE = 50  # maximum number of titles per one api.php request
+MAXLAG_RETRY_AFTER = 5  # seconds of waiting after maxlag error without Retry-After header
+
+
+class WikimediaApiError(IOError):
+    pass
+
+
+def get_api_url(domain, params):
+    '''
+    Return url of api.php with specified params for domain.
+    Parameter maxlag is settings.WIKIMEDIA_MAXLAG if it's defined
+    '''
+    from django.conf import settings
+    maxlag = getattr(settings, 'WIKIMEDIA_MAXLAG', None)
+    if maxlag is not None and 'maxlag' not in params:
+        params = dict(params, maxlag=str(maxlag))
+    params = [(key, val.encode('utf-8') if isinstance(val, unicode) else val) for key, val in sorted(params.items())]
+    return 'http://%s/w/api.php?%s' % (domain, urllib.urlencode(params))
+
+
+def request_api(domain, params, headers=None):
+    '''
+    Make request to api.php and return decoded response. Request failed with maxlag error
+    blocks domain in rate limiter for time of Retry-After header and repeats
+    '''
+    transport = get_transport()
+    for attempt in range(transport.retries + 1):
+        response = transport.open(urllib2.Request(url=get_api_url(domain, params), headers=headers or {}))
+        data = json.loads(response.content)
+        if data.get('error', {}).get('code') != 'maxlag' or attempt == transport.retries:
+            break
+        get_rate_limiter().block(domain, parse_retry_after(response.headers.get('retry-after')) or MAXLAG_RETRY_AFTER)
+
+    if 'error' in data:
+        raise WikimediaApiError('Error of api.php request to %s: %s' % (domain, data['error'].get('info', '')))
+    return data
+
+
+def query_revisions(domain, titles, content=True, headers=None):
+    '''
+    Query last revisions of titles with one api.php request (following continuations).
+    Returns dict {title: (revid, content)}, content is rendered html or None if content=False.
+    Titles normalized or redirected by wikimedia are returned with requested title,
+    missing titles are absent in result
+    '''
+    params = {
+        'action': 'query',
+        'prop': 'revisions',
+        'rvprop': 'ids|content' if content else 'ids',
+        'titles': u'|'.join(titles),
+        'redirects': '1',
+        'format': 'json',
+        'continue': '',
+    }
+    if content:
+        params['rvparse'] = '1'
+
+    pages = {}
+    aliases = {}
+    while True:
+        data = request_api(domain, params, headers)
+
+        query = data.get('query', {})
+        for alias in query.get('normalized', []) + query.get('redirects', []):
+            aliases[alias['from']] = alias['to']
+        for page in query.get('pages', {}).values():
+            revisions = page.get('revisions')
+            if revisions and page['title'] not in pages:
+                pages[page['title']] = (revisions[0]['revid'], revisions[0].get('*'))
+
+        if 'continue' not in data:
+            break
+        params.update(data['continue'])
+
+    result = {}
+    for title in titles:
+        name = title
+        # title could be normalized and then redirected
+        for i in range(3):
+            name = aliases.get(name, name)
+        if name in pages:
+            result[title] = pages[name]
+
+    return result
+
+
+def get_batches(pages):
+    '''
+    Group pages by domain into lists of API_BATCH_SIZE pages at most
+    '''
+    domains = {}
+    for page in pages:
+        domains.setdefault(page.get_domain(), []).append(page)
+
+    batches = []
+    for domain_pages in domains.values():
+        for i in range(0, len(domain_pages), API_BATCH_SIZE):
+            batches += [domain_pages[i:i + API_BATCH_SIZE]]
+    return batches
+
+
+def fetch_pages(pages):
+    '''
+    Fetch raw content and revision ids for pages of one domain with batched api.php requests.
+    Content is fetched only for new pages and pages with changed revision, others are left untouched.
+    Returns list of flags for every page: True if page content was fetched, False if page
+    was not modified and None if page was not found
+    '''
+    if not pages:
+        return []
+
+    domain = pages[0].get_domain()
+    headers = pages[0]._get_headers()
+    flags = [None] * len(pages)
+
+    # check revisions of already fetched pages before downloading content
+    fetched = [(i, page) for i, page in enumerate(pages) if page.id and page.content and page.revision]
+    revisions = query_revisions(domain, [page.title for i, page in fetched], content=False, headers=headers) \
+        if fetched else {}
+    for i, page in fetched:
+        if page.title in revisions and revisions[page.title][0] == page.revision:
+            flags[i] = False
+
+    titles = [page.title for i, page in enumerate(pages) if flags[i] is None]
+    contents = query_revisions(domain, titles, headers=headers) if titles else {}
+    for i, page in enumerate(pages):
+        if flags[i] is None and page.title in contents:
+            page.revision, page.content = contents[page.title]
+            flags[i] = True
+
+    return flags
+
+
+def get_recent_changes(domain, since, namespace=0):
+    '''
+    Return list of tuples (title, timestamp) of pages changed in domain since timestamp
+    in format YYYY-MM-DDTHH:MM:SSZ, the oldest changes first
+    '''
+    changes = []
+    for batch, continue_params in iter_recent_changes(domain, since, namespace=namespace):
+        changes += batch
+    return changes
+
+
+def iter_recent_changes(domain, since, continue_params=None, namespace=0):
+    '''
+    Yield tuples (changes, continue_params) for every response of recentchanges of domain since timestamp,
+    changes is a list of tuples (title, timestamp), the oldest changes first. Continue_params are
+    parameters of request of the next response or None for the last one, polling interrupted
+    after any response is resumed by passing its continue_params
+    '''
+    params = {
+        'action': 'query',
+        'list': 'recentchanges',
+        'rcprop': 'title|timestamp',
+        'rcnamespace': str(namespace),
+        'rcdir': 'newer',
+        'rcstart': since,
+        'rclimit': '500',
+        'format': 'json',
+        'continue': '',
+    }
+    if continue_params:
+        params.update(continue_params)
+
+    while True:
+        data = request_api(domain, params)
+        changes = [(change['title'], change['timestamp'])
+                   for change in data.get('query', {}).get('recentchanges', [])]
+        continue_params = data.get('continue')
+        yield changes, continue_params
+
+        if not continue_params:
+            break
+        params.update(continue_params)
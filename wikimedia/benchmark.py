@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from importlib import import_module
+import gzip
+import multiprocessing
+import os
+import resource
+import StringIO
+import threading
+import time
+import urlparse
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.test.utils import override_settings
+
+from models import Wikipage, Wikiproject
+
+__all__ = ['CORPUS_DIR', 'CORPUS_SIZES', 'PARSERS', 'TRANSPORTS', 'STAGES', 'load_corpus', 'StubServer',
+           'run_benchmark', 'benchmark']
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), 'testdata')
+CORPUS_SIZES = (1, 25, 100)  # numbers of repeats of every page of corpus for small, medium and large pages
+
+PARSERS = ('wikimedia.parsers.WikipageParserBeautifulsoup', 'wikimedia.parsers.WikipageParserLxml')
+TRANSPORTS = ('wikimedia.transport.UrllibTransport', 'wikimedia.transport.PooledTransport')
+STAGES = ('fetch', 'parse', 'remove_garbage', 'save')
+
+PROJECT_CODE = '_benchmark'
+
+
+def load_corpus(directory=CORPUS_DIR, sizes=CORPUS_SIZES):
+    '''
+    Return dict {title: (lang, html)} of pages from files <lang>_<title>.html of directory.
+    Every page is repeated for every size to get pages with many infoboxes and navboxes
+    '''
+    corpus = {}
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.html') or filename[2:3] != '_':
+            continue
+        with open(os.path.join(directory, filename)) as f:
+            content = f.read()
+        lang, title = filename[:2], filename[3:-5]
+        for size in sizes:
+            corpus['%s_%s_x%d' % (lang, title, size)] = (lang, content * size)
+    return corpus
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # send response with one write to keep-alive connections without delayed ACK
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        title = urlparse.parse_qs(urlparse.urlsplit(self.path).query).get('title', [''])[0]
+        page = self.server.corpus.get(title)
+        if page is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        content = page[1]
+        encoding = None
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buffer = StringIO.StringIO()
+            with gzip.GzipFile(fileobj=buffer, mode='wb') as file:
+                file.write(content)
+            content = buffer.getvalue()
+            encoding = 'gzip'
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+
+    '''
+    Local HTTP server returning pages of corpus by title like index.php?action=render
+    '''
+    daemon_threads = True
+
+    def __init__(self, corpus):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubRequestHandler)
+        self.corpus = dict((title, (lang, content.encode('utf-8') if isinstance(content, unicode) else content))
+                           for title, (lang, content) in corpus.items())
+        self.domain = '127.0.0.1:%d' % self.server_port
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+def get_class(path):
+    path = path.split('.')
+    return getattr(import_module('.'.join(path[:-1])), path[-1])
+
+
+def run_benchmark(corpus, domain, parser_path, transport_path, repeat=1):
+    '''
+    Fetch, parse and save every page of corpus from stub server domain sequentially repeat times
+    in transaction rolled back after all. Returns dict with number of pages, total seconds,
+    list of seconds of every stage and peak memory in kilobytes
+    '''
+    times = dict((stage, []) for stage in STAGES)
+
+    Parser = get_class(parser_path)
+
+    class TimedParser(Parser):
+        def remove_garbage(self):
+            start = time.time()
+            try:
+                return super(TimedParser, self).remove_garbage()
+            finally:
+                times['remove_garbage'].append(time.time() - start)
+
+    parser = TimedParser()
+    transport = get_class(transport_path)()
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    count = 0
+
+    with override_settings(WIKIMEDIA_RATE_LIMIT=None, WIKIMEDIA_RATE_LIMIT_DIR=None):
+        with transaction.atomic():
+            project = Wikiproject.objects.create(code=PROJECT_CODE, domain=domain)
+            started = time.time()
+            for i in range(repeat):
+                for title, (lang, content) in sorted(corpus.items()):
+                    page = Wikipage(project=project, lang=lang, title=title)
+
+                    start = time.time()
+                    page.content = transport.open(page._get_request()).content
+                    times['fetch'].append(time.time() - start)
+
+                    start = time.time()
+                    page.content = parser.process_content(page.content, page)
+                    times['parse'].append(time.time() - start - times['remove_garbage'][-1])
+
+                    start = time.time()
+                    page.save(fetch=False)
+                    times['save'].append(time.time() - start)
+
+                    Wikipage.objects.filter(id=page.id).delete()
+                    count += 1
+            seconds = time.time() - started
+            transaction.set_rollback(True)
+    # registry could be loaded with rolled back project
+    Wikiproject.objects.clear_registry()
+
+    if hasattr(transport, 'close'):
+        transport.close()
+
+    return {
+        'pages': count,
+        'seconds': seconds,
+        'times': times,
+        'start_rss': start_rss,
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def _run_isolated(queue, *args):
+    try:
+        queue.put(run_benchmark(*args))
+    except Exception, e:
+        queue.put(e)
+    finally:
+        connection.close()
+
+
+def benchmark(corpus, parsers=PARSERS, transports=TRANSPORTS, repeat=1, isolate=True):
+    '''
+    Run benchmark for every parser and transport with stub server of corpus and return list of tuples
+    (parser, transport, result), result is None for parsers not available. With isolate=True
+    every benchmark runs in own process, so peak memory of different parsers is comparable
+    '''
+    results = []
+    with StubServer(corpus) as server:
+        for parser_path in parsers:
+            for transport_path in transports:
+                args = (corpus, server.domain, parser_path, transport_path, repeat)
+                try:
+                    get_class(parser_path)()
+                except ImproperlyConfigured:
+                    # engine is not installed
+                    results += [(parser_path, transport_path, None)]
+                    continue
+
+                if isolate:
+                    # child process must not share connection with parent
+                    connection.close()
+                    queue = multiprocessing.Queue()
+                    process = multiprocessing.Process(target=_run_isolated, args=(queue,) + args)
+                    process.start()
+                    result = queue.get()
+                    process.join()
+                    if isinstance(result, Exception):
+                        raise result
+                else:
+                    result = run_benchmark(*args)
+                results += [(parser_path, transport_path, result)]
+    return results
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+__all__ = ['get_cache', 'get_content', 'set_content', 'invalidate_wikipage', 'get_stats', 'reset_stats']
+
+KEY_PREFIX = 'wikimedia'
+
+_stats = {'hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+
+def get_cache():
+    '''
+    Return cache backend defined in settings.WIKIMEDIA_CACHE or None if caching is disabled
+    '''
+    from django.conf import settings
+    alias = getattr(settings, 'WIKIMEDIA_CACHE', None)
+    if alias is None:
+        return None
+
+    from django.core.cache import caches
+    return caches[alias]
+
+
+def get_timeout():
+    from django.conf import settings
+    return getattr(settings, 'WIKIMEDIA_CACHE_TIMEOUT', 60 * 60 * 24)
+
+
+def _version_key(content_type_id, object_id):
+    return '%s:version:%s:%s' % (KEY_PREFIX, content_type_id, object_id)
+
+
+def _get_version(cache, content_type_id, object_id):
+    '''
+    Return current version of object pages, versions start from timestamp to never repeat after eviction
+    '''
+    key = _version_key(content_type_id, object_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+    return version
+
+
+def _content_key(cache, content_type_id, object_id, project_code, lang):
+    return '%s:content:%s:%s:%s:%s:%s' % (KEY_PREFIX, content_type_id, object_id, project_code, lang,
+                                          _get_version(cache, content_type_id, object_id))
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def get_content(content_type_id, object_id, project_code, lang):
+    '''
+    Return cached content of wikipage of object or None if it's not cached.
+    Ids of object are None for pages without objects
+    '''
+    cache = get_cache()
+    if cache is None:
+        return None
+
+    content = cache.get(_content_key(cache, content_type_id, object_id, project_code, lang))
+    _count('misses' if content is None else 'hits')
+    return content
+
+
+def set_content(content_type_id, object_id, project_code, lang, content):
+    '''
+    Cache content of wikipage of object, empty content is cached for absent pages
+    '''
+    cache = get_cache()
+    if cache is not None:
+        cache.set(_content_key(cache, content_type_id, object_id, project_code, lang), content, get_timeout())
+
+
+def invalidate_wikipage(instance, **kwargs):
+    '''
+    Bump versions of cached pages of object of the wikipage and pages without objects.
+    Receiver for post_save and post_delete signals of Wikipage
+    '''
+    cache = get_cache()
+    if cache is None:
+        return
+
+    keys = set([(None, None), (instance.content_type_id, instance.object_id)])
+    for content_type_id, object_id in keys:
+        key = _version_key(content_type_id, object_id)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, int(time.time() * 1000), None)
+
+
+def get_stats():
+    '''
+    Return dict with counters of cache hits and misses of this process
+    '''
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_lock:
+        for name in _stats:
+            _stats[name] = 0
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+__all__ = ['load_checkpoint', 'save_checkpoint']
+
+
+def load_checkpoint(path, default):
+    '''
+    Return state of long running job saved in JSON file or default if there is no file
+    '''
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return default
+
+
+def save_checkpoint(path, state):
+    '''
+    Save state of long running job to JSON file, file is replaced atomically to never leave broken checkpoint
+    '''
+    if not path:
+        return
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp, path)
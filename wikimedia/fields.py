@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import base64
+import zlib
+
+from django.conf import settings
+from django.db import models
+from django.utils.encoding import force_text
+
+__all__ = ['COMPRESSED_PREFIX', 'compress', 'decompress', 'CompressedTextField']
+
+COMPRESSED_PREFIX = u'zlib:'
+
+
+def compress(value):
+    '''
+    Return zlib compressed and base64 encoded value with prefix, byte strings are treated as utf-8
+    '''
+    if not value:
+        return value
+    value = force_text(value)
+    if value.startswith(COMPRESSED_PREFIX):
+        return value
+    return COMPRESSED_PREFIX + base64.b64encode(zlib.compress(value.encode('utf-8'), 6)).decode('ascii')
+
+
+def decompress(value):
+    '''
+    Return value back from compressed form, values without prefix are returned as is
+    (byte strings decoded from utf-8)
+    '''
+    if not value:
+        return value
+    value = force_text(value)
+    if not value.startswith(COMPRESSED_PREFIX):
+        return value
+    return zlib.decompress(base64.b64decode(value[len(COMPRESSED_PREFIX):])).decode('utf-8')
+
+
+class CompressedTextField(models.TextField):
+
+    '''
+    Text field storing values compressed if settings.WIKIMEDIA_COMPRESS_CONTENT is True.
+    Value is always available decompressed from model attribute, compressed and plain values
+    could be stored in the same table. Database lookups by content of compressed values are not possible
+    '''
+
+    def from_db_value(self, value, *args):
+        return decompress(value)
+
+    def to_python(self, value):
+        return decompress(super(CompressedTextField, self).to_python(value))
+
+    def get_prep_value(self, value):
+        value = super(CompressedTextField, self).get_prep_value(value)
+        if getattr(settings, 'WIKIMEDIA_COMPRESS_CONTENT', False):
+            value = compress(value)
+        return value
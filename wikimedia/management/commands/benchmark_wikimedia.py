@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from wikimedia.benchmark import CORPUS_DIR, PARSERS, TRANSPORTS, STAGES, load_corpus, benchmark
+
+
+class Command(BaseCommand):
+
+    help = 'Measure throughput, latency of stages and peak memory of fetching, parsing and saving wikipages ' \
+           'for every parser and transport with local stub server of pages corpus'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corpus', dest='corpus', default=CORPUS_DIR,
+                            help='Directory with files <lang>_<title>.html of pages rendered by action=render')
+        parser.add_argument('--parser', action='append', dest='parsers', help='Path of parser class, all by default')
+        parser.add_argument('--transport', action='append', dest='transports',
+                            help='Path of transport class, all by default')
+        parser.add_argument('--repeat', type=int, dest='repeat', default=3, help='Number of passes over corpus')
+        parser.add_argument('--no-isolate', action='store_false', dest='isolate', default=True,
+                            help='Run all benchmarks in this process')
+
+    def handle(self, *args, **options):
+        corpus = load_corpus(options['corpus'])
+        self.stdout.write('Corpus of %d pages, %d KB' % (
+            len(corpus), sum([len(content) for lang, content in corpus.values()]) / 1024))
+
+        results = benchmark(corpus, parsers=options['parsers'] or PARSERS,
+                            transports=options['transports'] or TRANSPORTS,
+                            repeat=options['repeat'], isolate=options['isolate'])
+
+        self.stdout.write('%-45s %-40s %9s %s %12s' % ('parser', 'transport', 'pages/s',
+                                                        ' '.join(['%14s' % stage for stage in STAGES]), 'peak KB'))
+        for parser, transport, result in results:
+            if result is None:
+                self.stdout.write('%-45s %-40s not available' % (parser, transport))
+                continue
+            stages = []
+            for stage in STAGES:
+                times = result['times'][stage]
+                # mean and max latency in milliseconds
+                stages += ['%6.1f/%7.1f' % (sum(times) / len(times) * 1000, max(times) * 1000) if times else '-']
+            self.stdout.write('%-45s %-40s %9.1f %s %12d' % (
+                parser, transport, result['pages'] / result['seconds'], ' '.join(['%14s' % s for s in stages]),
+                result['peak_rss'] - result['start_rss']))
+        self.stdout.write('Latency of stages is mean/max in ms, peak memory is growth of maximum RSS')
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from wikimedia.fields import COMPRESSED_PREFIX
+from wikimedia.models import Wikipage
+
+
+class Command(BaseCommand):
+
+    help = 'Convert content of existing wikipages to the storage format of settings.WIKIMEDIA_COMPRESS_CONTENT: ' \
+           'compress plain content if it is enabled or decompress content otherwise'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, dest='batch_size',
+                            help='Number of pages converted in one transaction')
+
+    def handle(self, *args, **options):
+        compress = getattr(settings, 'WIKIMEDIA_COMPRESS_CONTENT', False)
+        if compress:
+            queryset = Wikipage.objects.exclude(content__startswith=COMPRESSED_PREFIX).exclude(content='')
+        else:
+            queryset = Wikipage.objects.filter(content__startswith=COMPRESSED_PREFIX)
+        queryset = queryset.only('id', 'content').order_by('id')
+
+        count = 0
+        last_id = 0
+        while True:
+            pages = list(queryset.filter(id__gt=last_id)[:options['batch_size']])
+            if not pages:
+                break
+
+            with transaction.atomic():
+                for page in pages:
+                    # content is prepared for DB according to the setting, without touching updated field
+                    Wikipage.objects.filter(id=page.id).update(content=page.content)
+            count += len(pages)
+            last_id = pages[-1].id
+
+        self.stdout.write('%s %d wikipages' % ('Compressed' if compress else 'Decompressed', count))
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from wikimedia.models import Wikipage
+from wikimedia.reparse import WikipageReparse
+
+
+class Command(BaseCommand):
+
+    help = 'Process wikipages again with current parser settings by pool of processes without network access. ' \
+           'Pages are processed from stored raw responses or from their current content in DB'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', choices=['store', 'db'], default='store', dest='source',
+                            help='Process stored raw responses or current content of pages')
+        parser.add_argument('--store', dest='store',
+                            help='Directory of raw responses, settings.WIKIMEDIA_RESPONSE_STORE by default')
+        parser.add_argument('--processes', type=int, dest='processes',
+                            help='Number of worker processes, number of CPUs by default')
+        parser.add_argument('--chunk-size', type=int, default=500, dest='chunk_size',
+                            help='Number of pages read and written in one transaction')
+        parser.add_argument('--checkpoint', dest='checkpoint',
+                            help='Path to JSON file with progress of reparse to resume it')
+        parser.add_argument('--project', dest='project', help='Code of project of pages')
+        parser.add_argument('--lang', dest='lang', help='Language of pages')
+
+    def handle(self, *args, **options):
+        directory = None
+        if options['source'] == 'store':
+            directory = options['store'] or getattr(settings, 'WIKIMEDIA_RESPONSE_STORE', None)
+            if not directory:
+                raise CommandError('Directory of raw responses is not defined')
+
+        queryset = Wikipage.objects.all()
+        if options['project']:
+            queryset = queryset.filter(project=options['project'])
+        if options['lang']:
+            queryset = queryset.filter(lang=options['lang'])
+
+        def progress(processed, total):
+            if options['verbosity'] > 0:
+                self.stdout.write('Processed %d of %d wikipages' % (processed, total))
+
+        reparse = WikipageReparse(directory, options['processes'], options['chunk_size'], options['checkpoint'])
+        reparse.run(queryset, progress)
+
+        self.stdout.write('Reparsed %d wikipages, %d without stored response' % (reparse.count, reparse.missing))
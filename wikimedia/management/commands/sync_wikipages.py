@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from wikimedia.sync import WikipageSync
+
+
+class Command(BaseCommand):
+
+    help = 'Refresh wikipages not updated longer than max age and optionally pages changed ' \
+           'according to recentchanges of wikimedia domains'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=float, dest='max_age',
+                            help='Age of stale pages in hours, settings.WIKIMEDIA_SYNC_MAX_AGE by default')
+        parser.add_argument('--limit', type=int, dest='limit', help='Maximum number of stale pages to refresh')
+        parser.add_argument('--recent-changes', action='store_true', dest='recent_changes', default=False,
+                            help='Poll recentchanges of domains and refresh changed pages')
+        parser.add_argument('--no-stale', action='store_false', dest='stale', default=True,
+                            help='Do not refresh stale pages')
+        parser.add_argument('--checkpoint', dest='checkpoint', help='Path to JSON file with progress of sync')
+        parser.add_argument('--concurrency', type=int, dest='concurrency', default=4)
+        parser.add_argument('--use-api', action='store_true', dest='use_api', default=None,
+                            help='Fetch pages from api.php with batched requests')
+
+    def handle(self, *args, **options):
+        sync = WikipageSync(max_age=timedelta(hours=options['max_age']) if options['max_age'] else None,
+                            checkpoint=options['checkpoint'], concurrency=options['concurrency'],
+                            use_api=options['use_api'])
+        if options['recent_changes']:
+            sync.sync_recent_changes()
+        if options['stale']:
+            sync.sync_stale(options['limit'])
+
+        for item, error in sync.errors:
+            self.stderr.write('Error of updating %s: %s' % (item, error))
+        self.stdout.write('Refreshed %d wikipages, %d errors' % (len(sync.pages), len(sync.errors)))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from importlib import import_module
+import logging
+
+from django.core.exceptions import ImproperlyConfigured
+from django.dispatch import Signal
+
+try:
+    # Django 1.8
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
+
+__all__ = ['metric', 'BaseMetricsSink', 'SignalMetricsSink', 'LoggingMetricsSink', 'get_sink']
+
+logger = logging.getLogger(__name__)
+
+# sent by SignalMetricsSink for every measurement, kind is "timing" (value in seconds) or "counter"
+metric = Signal(providing_args=['name', 'kind', 'value', 'tags'])
+
+_sink = None
+_sink_loaded = False
+
+
+def get_sink():
+    '''
+    Return shared instance of metrics sink defined in settings.WIKIMEDIA_METRICS_SINK or None if metrics
+    are disabled. Hooks check returned value before measuring anything, so disabled metrics cost nothing
+    '''
+    global _sink, _sink_loaded
+    if not _sink_loaded:
+        from django.conf import settings
+        sink = getattr(settings, 'WIKIMEDIA_METRICS_SINK', None)
+        if sink is not None:
+            try:
+                sink_path = sink.split('.')
+                sink_module = import_module('.'.join(sink_path[:-1]))
+                Sink = getattr(sink_module, sink_path[-1])
+            except (ImportError, AttributeError), e:
+                raise ImproperlyConfigured('Error importing wikimedia metrics sink %s: "%s"' % (sink, e))
+            sink = Sink()
+        _sink, _sink_loaded = sink, True
+
+    return _sink
+
+
+def clear_sink_cache(setting=None, **kwargs):
+    global _sink, _sink_loaded
+    if setting in (None, 'WIKIMEDIA_METRICS_SINK'):
+        _sink, _sink_loaded = None, False
+
+setting_changed.connect(clear_sink_cache)
+
+
+class BaseMetricsSink(object):
+
+    '''
+    Receiver of measurements of fetching, parsing and saving wikipages.
+    Measurements:
+        wikimedia.fetch - timing of HTTP request with tags domain and status
+        wikimedia.fetch.bytes - counter of received bytes with tags domain and status
+        wikimedia.process - timing of processing content by parser with tags domain and parser
+        wikimedia.parse_content - timing of parse_content stage of parser with tags domain and parser
+        wikimedia.remove_garbage - timing of remove_garbage stage of parser with tags domain and parser
+        wikimedia.remove_garbage.removed - counter of removed elements with tags domain and rule
+        wikimedia.save - timing of writing page to DB with tag domain
+        wikimedia.bulk_save - timing of writing batch of pages to DB with tag pages (number of pages)
+    '''
+
+    def timing(self, name, seconds, **tags):
+        raise NotImplementedError
+
+    def increment(self, name, value=1, **tags):
+        raise NotImplementedError
+
+
+class SignalMetricsSink(BaseMetricsSink):
+
+    '''
+    Sink sending measurements as signal wikimedia.metrics.metric, for example to feed StatsD or Prometheus
+    '''
+
+    def timing(self, name, seconds, **tags):
+        metric.send(sender=self.__class__, name=name, kind='timing', value=seconds, tags=tags)
+
+    def increment(self, name, value=1, **tags):
+        metric.send(sender=self.__class__, name=name, kind='counter', value=value, tags=tags)
+
+
+class LoggingMetricsSink(BaseMetricsSink):
+
+    '''
+    Sink writing measurements to log with debug level, useful for profiling slow pages
+    '''
+
+    def timing(self, name, seconds, **tags):
+        logger.debug('%s %.1fms %s', name, seconds * 1000, tags)
+
+    def increment(self, name, value=1, **tags):
+        logger.debug('%s +%s %s', name, value, tags)
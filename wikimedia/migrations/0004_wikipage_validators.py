@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wikimedia', '0003_auto_20151013_2156'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wikipage',
+            name='etag',
+            field=models.CharField(max_length=100, verbose_name='ETag of last response', editable=False, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='wikipage',
+            name='last_modified',
+            field=models.CharField(max_length=50, verbose_name='Last-Modified of last response', editable=False, blank=True),
+            preserve_default=True,
+        ),
+    ]
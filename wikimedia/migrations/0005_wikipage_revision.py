@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wikimedia', '0004_wikipage_validators'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wikipage',
+            name='revision',
+            field=models.PositiveIntegerField(verbose_name='Revision id', null=True, editable=False),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import wikimedia.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wikimedia', '0005_wikipage_revision'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='wikipage',
+            name='content',
+            field=wikimedia.fields.CompressedTextField(verbose_name='Content'),
+            preserve_default=True,
+        ),
+    ]
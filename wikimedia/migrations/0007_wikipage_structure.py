@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wikimedia', '0006_wikipage_compressed_content'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wikipage',
+            name='structure',
+            field=models.TextField(verbose_name='Structure of content', blank=True, editable=False),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wikimedia', '0007_wikipage_structure'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WikipageSisterLink',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('title', models.CharField(max_length=300, verbose_name='Title')),
+                ('position', models.PositiveSmallIntegerField(default=0, verbose_name='Position')),
+                ('page', models.ForeignKey(related_name='sister_links', to='wikimedia.Wikipage')),
+                ('project', models.ForeignKey(to='wikimedia.Wikiproject')),
+            ],
+            options={
+                'ordering': ('page', 'position'),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='wikipagesisterlink',
+            unique_together=set([('page', 'project', 'title')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='wikipagesisterlink',
+            index_together=set([('project', 'title')]),
+        ),
+    ]
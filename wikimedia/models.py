@@ -1,11 +1,26 @@
 # -*- coding: utf-8 -*-
 from importlib import import_module
+import operator
+import time
 
-from django.db import models
+from multiprocessing.pool import ThreadPool
+
+from django.db import models, transaction, connection, DatabaseError
+from django.db.models import Q
+from django.db.models.functions import Substr
+from django.db.models.signals import post_save, post_delete
 from django.conf import settings
 from django.utils.translation import get_language, ugettext_lazy as _
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ImproperlyConfigured
+from transport import get_transport
+from store import get_store
+import api
+import cache
+import tasks
+from metrics import get_sink
+import structure
+from fields import COMPRESSED_PREFIX, CompressedTextField
 from utils import url_fix
 import urllib2
 
@@ -15,23 +30,61 @@ try:
 except ImportError:
     from django.contrib.contenttypes.generic import GenericForeignKey
 
+try:
+    # Django 1.8
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
+
 
-__all__ = ['WikipageTitleError', 'WikipageManager', 'Wikipage', 'Wikiproject']
+__all__ = ['WikipageTitleError', 'WikipageManager', 'Wikipage', 'Wikiproject', 'WikipageSisterLink',
+           'prefetch_wikipages']
 
 LANGUAGES = getattr(settings, 'WIKIMEDIA_LANGUAGES', [('en', _('English'))])
+LANGUAGE_CODES = frozenset([l[0] for l in LANGUAGES])
+
+WIKIPAGES_CACHE_NAME = '_wikipages_cache'
+PREFETCH_CHUNK_SIZE = 500  # maximum number of objects ids in one query
+VALIDATOR_FIELDS = ('etag', 'last_modified', 'revision', 'updated')  # fields revalidated by conditional requests
+
+
+_parsers = {}
 
 
 def get_parser():
+    '''
+    Return shared instance of parser defined in settings.WIKIMEDIA_PARSER.
+    Parsers keep state of processing in thread locals, so instance is safe to use from many threads
+    '''
     from django.conf import settings
+    parser = getattr(settings, 'WIKIMEDIA_PARSER', 'wikimedia.parsers.WikipageParserBeautifulsoup')
+    try:
+        return _parsers[parser]
+    except KeyError:
+        pass
+
     try:
-        parser = getattr(settings, 'WIKIMEDIA_PARSER', 'wikimedia.parsers.WikipageParserBeautifulsoup')
         parser_path = parser.split('.')
         parser_module = import_module('.'.join(parser_path[:-1]))
         WikipageParser = getattr(parser_module, parser_path[-1])
     except ImportError, e:
         raise ImproperlyConfigured('Error importing wikipage parsing module %s: "%s"' % (parser, e))
 
-    return WikipageParser()
+    return _parsers.setdefault(parser, WikipageParser())
+
+
+def clear_parser_cache(setting=None, **kwargs):
+    if setting in (None, 'WIKIMEDIA_PARSER'):
+        _parsers.clear()
+
+setting_changed.connect(clear_parser_cache)
+
+
+def clear_wikipages_cache(object):
+    '''
+    Remove wikipages cached in the object by WikipageManager
+    '''
+    object.__dict__.pop(WIKIPAGES_CACHE_NAME, None)
 
 
 class WikipageTitleError(ValueError):
@@ -52,8 +105,13 @@ class WikipageManager(models.Manager):
             object.wikimedia.wikiquote,
             object.wikimedia.wikiquote_ru,
             ...
-        Attribute without language returns with respect to current language
+        Attribute without language returns with respect to current language.
+        All pages of related object are loaded with one query and cached in the object.
+        Content is served from cache backend settings.WIKIMEDIA_CACHE if it's defined
         '''
+        if name.startswith('_'):
+            raise AttributeError("'WikimediaManager' object has no attribute '%s'" % name)
+
         if name.find('_') == -1:
             project_code = name
             lang = get_language()
@@ -65,53 +123,496 @@ class WikipageManager(models.Manager):
         try:
             lang = self.get_language(lang)
             project = self.get_project(project_code)
-        except:
+        except ValueError:
             raise AttributeError("'WikimediaManager' object has no attribute '%s'" % name)
 
-        try:
-            return self.filter(project__code=project_code, lang=lang)[0].content
-        except:
-            return ''
+        instance = self.__dict__.get('instance')
+        if instance is not None and WIKIPAGES_CACHE_NAME in instance.__dict__:
+            page = self.get_page(project.code, lang)
+            return page.content if page else ''
+
+        content_type_id = ContentType.objects.get_for_model(instance).id if instance is not None else None
+        object_id = instance.pk if instance is not None else None
+        content = cache.get_content(content_type_id, object_id, project.code, lang)
+        if content is None:
+            page = self.get_page(project.code, lang)
+            content = page.content if page else ''
+            cache.set_content(content_type_id, object_id, project.code, lang, content)
+        return content
 
-    def update(self, title, lang, project_code='wikipedia', object=None, with_sister_projects=False):
+    def get_queryset(self):
+        queryset = super(WikipageManager, self).get_queryset()
+        object_filters = self.__dict__.get('object_filters')
+        return queryset.filter(**object_filters) if object_filters else queryset
+
+    def for_object(self, object):
+        '''
+        Return manager of wikipages of object, the same as manager of GenericRelation to Wikipage
+        '''
+        manager = self.__class__()
+        manager.model = self.model
+        manager.instance = object
+        manager.object_filters = dict(object_id=object.id, content_type=ContentType.objects.get_for_model(object))
+        return manager
+
+    def get_page(self, project_code, lang):
+        '''
+        Return wikipage of project and lang or None.
+        For manager of related object all pages of object are loaded once and cached in the object
+        '''
+        instance = self.__dict__.get('instance')
+        if instance is None:
+            try:
+                return self.filter(project=project_code, lang=lang)[0]
+            except IndexError:
+                return None
+
+        pages = instance.__dict__.get(WIKIPAGES_CACHE_NAME)
+        if pages is None:
+            pages = {}
+            for page in self.all():
+                # the latest updated page first
+                pages.setdefault((page.project_id, page.lang), page)
+            setattr(instance, WIKIPAGES_CACHE_NAME, pages)
+
+        return pages.get((project_code, lang))
+
+    def prefetch(self, objects, projects=None, langs=None, fields=None):
+        '''
+        Load wikipages of many objects with one query for every content type and cache them in objects,
+        so object.wikimedia.<project>_<lang> makes no queries. Returns list of objects.
+        Projects and langs are lists of codes limiting loaded pages, other pages are not available
+        from cache then. Fields limits loaded fields of pages, for example to defer large content
+        '''
+        objects = list(objects)
+        objects_by_type = {}
+        for object in objects:
+            objects_by_type.setdefault(ContentType.objects.get_for_model(object), {}) \
+                .setdefault(object.id, []).append(object)
+            setattr(object, WIKIPAGES_CACHE_NAME, {})
+
+        for content_type, objects_by_id in objects_by_type.items():
+            queryset = self.get_queryset().filter(content_type=content_type)
+            if projects is not None:
+                queryset = queryset.filter(project__in=projects)
+            if langs is not None:
+                queryset = queryset.filter(lang__in=langs)
+            if fields is not None:
+                queryset = queryset.only(*set(fields) | set(['project', 'lang', 'object_id', 'updated']))
+
+            ids = objects_by_id.keys()
+            for i in range(0, len(ids), PREFETCH_CHUNK_SIZE):
+                for page in queryset.filter(object_id__in=ids[i:i + PREFETCH_CHUNK_SIZE]):
+                    for object in objects_by_id[page.object_id]:
+                        # the latest updated page first
+                        getattr(object, WIKIPAGES_CACHE_NAME).setdefault((page.project_id, page.lang), page)
+
+        return objects
+
+    def update(self, title, lang, project_code='wikipedia', object=None, with_sister_projects=False,
+               max_depth=1, max_fan_out=10, concurrency=4):
         '''
         Method for update wikipage with specified title, lang for object
-        Allows chaining updates with with_sister_projects=True
+        Allows chaining updates with with_sister_projects=True: sister projects found on the page
+        are fetched concurrently level by level up to max_depth levels and max_fan_out pages
+        of every page, then all pages of object are saved in one transaction
         '''
         lang = self.get_language(lang)
         project = self.get_project(project_code)
 
+        if with_sister_projects:
+            return self._update_chain(title, lang, project, object, max_depth, max_fan_out, concurrency)
+
+        lookup = dict(project=project, lang=lang, title=title)
+        if object:
+            content_type = ContentType.objects.get_for_model(object)
+            filter_delete_dict = dict(object_id=object.id, content_type=content_type, lang=lang)
+            lookup.update(object_id=object.id, content_type=content_type)
+
         try:
+            page = self.get(**lookup)
+        except self.model.DoesNotExist:
+            # new page is fetched regardless of settings.WIKIMEDIA_FETCH_ON_SAVE
+            page = self.model(**lookup)
+            try:
+                page.refresh()
+            except urllib2.HTTPError, e:
+                if e.code == 404:
+                    raise WikipageTitleError(page.get_title_error())
+                raise
+
+        if object:
+            # if updating without sister projects => removing only existed pages of current project
+            self.filter(project=project, **filter_delete_dict).exclude(id=page.id).delete()
+            clear_wikipages_cache(object)
+
+        return page
+
+    def update_async(self, title, lang, project_code='wikipedia', object=None, with_sister_projects=False):
+        '''
+        Submit updating of wikipage to task executor settings.WIKIMEDIA_TASK_EXECUTOR and return
+        tasks.TaskFuture. Duplicate updates of the same page are coalesced while page is updating
+        '''
+        return tasks.get_executor().submit_update(title, lang, project_code, object, with_sister_projects)
+
+    def _update_chain(self, title, lang, project, object, max_depth, max_fan_out, concurrency):
+        '''
+        Update page with chain of sister projects using work queue of levels, every level
+        is fetched with pool of threads. Returns the first page
+        '''
+        content_type = ContentType.objects.get_for_model(object) if object else None
+        level = [(title, lang, project.code, object)]
+        seen = set([(project.code, title)])
+        pages = []
+
+        for depth in range(max_depth + 1):
+            pending = self._get_pending(level)
+            if depth < max_depth:
+                # pages not modified since last fetching keep their stored links to sister projects
+                WikipageSisterLink.objects.prefetch([page for item, page in pending if page.id])
+
+            level = []
+            for item, page, save, error in self._fetch(pending, concurrency):
+                if error:
+                    if not pages:
+                        raise error
+                    elif isinstance(error, WikipageTitleError):
+                        continue
+                    raise error
+                pages += [(page, save)]
+
+                if depth < max_depth:
+                    for project_code, sister_title in page.sister_projects[:max_fan_out]:
+                        if (project_code, sister_title) not in seen:
+                            seen.add((project_code, sister_title))
+                            level += [(sister_title, lang, project_code, object)]
+            if not level:
+                break
+
+        with transaction.atomic():
+            self.bulk_save([page for page, save in pages if save])
             if object:
-                filter_delete_dict = dict(
-                    object_id=object.id, content_type=ContentType.objects.get_for_model(object), lang=lang)
-                page = self.get_or_create(project=project, lang=lang, title=title,
-                                          object_id=object.id, content_type=ContentType.objects.get_for_model(object))[0]
-            else:
-                page = self.get_or_create(project=project, lang=lang, title=title)[0]
+                # delete all others wikimedia pages for this object (every projects)
+                self.filter(object_id=object.id, content_type=content_type, lang=lang) \
+                    .exclude(id__in=[page.id for page, save in pages]).delete()
 
-        except urllib2.HTTPError:
-            raise WikipageTitleError('Incorrect %s title (%s) with lang "%s"' %
-                                     (project_code, title.encode('utf-8'), lang))
+        if object:
+            clear_wikipages_cache(object)
 
-        # update all found sister projects
-        if with_sister_projects:
+        return pages[0][0]
 
-            # delete all others wikimedia pages for this object (every projects)
+    def _get_pending(self, items):
+        '''
+        Return list of tuples (item, page) for valid items (title, lang, project_code, object),
+        pages are existing pages or new ones, loaded with one query for every project and lang.
+        Object of page is changed to the object of item
+        '''
+        titles = {}
+        for title, lang, project_code, object in items:
+            titles.setdefault((self.get_project(project_code), lang), []).append(title)
+
+        existing = {}
+        for (project, lang), project_titles in titles.items():
+            for page in self.filter(project=project, lang=lang, title__in=project_titles):
+                # worker threads should not query projects
+                page.project = project
+                existing[(project.code, lang, page.title)] = page
+
+        # the same page requested twice is fetched once, last object wins
+        unique = {}
+        keys = []
+        for item in items:
+            title, lang, project_code, object = item
+            key = (project_code, lang, title)
+            if key not in unique:
+                unique[key] = (item, existing.get(key) or
+                               Wikipage(project=self.get_project(project_code), lang=lang, title=title))
+            page = unique[key][1]
             if object:
-                self.filter(**filter_delete_dict).exclude(id=page.id).delete()
+                content_type = ContentType.objects.get_for_model(object)
+                if (page.object_id, page.content_type_id) != (object.id, content_type.id):
+                    page.object_id = object.id
+                    page.content_type = content_type
+                    page._object_changed = True
+            keys += [key]
+        return [unique.pop(key) for key in keys if key in unique]
 
-            for project_code, title in page.sister_projects:
-                try:
-                    self.update(title, lang, project_code, object)
-                except WikipageTitleError:
+    def bulk_update(self, items, concurrency=4, batch_size=100, use_api=None):
+        '''
+        Method for update many wikipages at once.
+        Items is an iterable of tuples (title, lang[, project_code[, object]]).
+        Pages are fetched and parsed by a bounded pool of worker threads and saved to DB
+        in transactions of batch_size pages.
+        With use_api=True (settings.WIKIMEDIA_USE_API by default) pages are fetched
+        from api.php with one request for every api.API_BATCH_SIZE pages of the same domain.
+        Returns tuple (pages, errors), where errors is a list of (item, exception) tuples
+        for items failed to update, for example with WikipageTitleError
+        '''
+        pages = []
+        errors = []
+        pending = []
+        objects = []
+
+        for item in items:
+            title, lang, project_code, object = (tuple(item) + ('wikipedia', None)[len(item) - 2:])[:4]
+            try:
+                lang = self.get_language(lang)
+                project_code = self.get_project(project_code).code
+            except ValueError, e:
+                errors += [(item, e)]
+                continue
+
+            pending += [(item, (title, lang, project_code, object))]
+            if object:
+                objects += [object]
+
+        original_items = dict((id(normalized), item) for item, normalized in pending)
+        pending = [(original_items[id(normalized)], page)
+                   for normalized, page in self._get_pending([normalized for item, normalized in pending])]
+
+        try:
+            batch = []
+            for item, page, save, error in self._fetch(pending, concurrency, use_api):
+                if error:
+                    errors += [(item, error)]
+                    continue
+                elif not save:
+                    pages += [page]
                     continue
+                batch += [(item, page)]
+                if len(batch) >= batch_size:
+                    self._save_batch(batch, pages, errors)
+                    batch = []
+            if batch:
+                self._save_batch(batch, pages, errors)
+        finally:
+            for object in objects:
+                clear_wikipages_cache(object)
 
-        elif object:
-            # if updating without sister projects => removing only existed pages of current project
-            self.filter(project=project, **filter_delete_dict).exclude(id=page.id).delete()
+        return pages, errors
 
-        return page
+    def _fetch(self, pending, concurrency=4, use_api=None):
+        '''
+        Fetch and parse pages of list of tuples (item, page) by pool of worker threads.
+        Yields tuples (item, page, save, error) as soon as every job is done in order of jobs,
+        save is False for pages not modified since last fetching
+        '''
+        if use_api is None:
+            use_api = getattr(settings, 'WIKIMEDIA_USE_API', False)
+        if use_api:
+            page_items = dict((id(page), item) for item, page in pending)
+            jobs = [[(page_items[id(page)], page) for page in batch]
+                    for batch in api.get_batches([page for item, page in pending])]
+        else:
+            jobs = [[pending_item] for pending_item in pending]
+
+        def fetch(job):
+            results = []
+            try:
+                if use_api:
+                    flags = api.fetch_pages([page for item, page in job])
+                for i, (item, page) in enumerate(job):
+                    try:
+                        if not use_api:
+                            modified = page.fetch_content()
+                        elif flags[i] is None:
+                            raise WikipageTitleError(page.get_title_error())
+                        else:
+                            modified = flags[i]
+                            if modified:
+                                page.store_response(page.revision)
+                                page.process_content()
+                    except urllib2.HTTPError, e:
+                        # only missing page is error of title, other statuses are failures of fetching
+                        results += [(item, page, False,
+                                     WikipageTitleError(page.get_title_error()) if e.code == 404 else e)]
+                    except Exception, e:
+                        results += [(item, page, False, e)]
+                    else:
+                        # page not modified since last fetching has nothing to save
+                        results += [(item, page, modified or not page.id or getattr(page, '_object_changed', False),
+                                     None)]
+            except Exception, e:
+                # failed request of api batch
+                results = [(item, page, False, e) for item, page in job]
+            finally:
+                # connections opened by worker threads are never reused
+                connection.close()
+            return results
+
+        pool = ThreadPool(max(1, min(concurrency, len(jobs))))
+        try:
+            for results in pool.imap(fetch, jobs):
+                for result in results:
+                    yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    def _save_batch(self, batch, pages, errors):
+        '''
+        Save already fetched pages in one transaction and remove previous pages
+        of the same project for their objects with bulk_save. If it fails, every page
+        is saved in own savepoint and failed pages are added to errors
+        '''
+        new_pages = [page for item, page in batch if page.id is None]
+        try:
+            self.bulk_save([page for item, page in batch], delete_stale=True)
+        except DatabaseError:
+            for page in new_pages:
+                page.id = None
+                page._state.adding = True
+        else:
+            pages += [page for item, page in batch]
+            return
+
+        with transaction.atomic():
+            for item, page in batch:
+                try:
+                    with transaction.atomic():
+                        page.save(fetch=False)
+                        if page.object_id:
+                            self.filter(project=page.project, lang=page.lang, object_id=page.object_id,
+                                        content_type=page.content_type).exclude(id=page.id).delete()
+                except DatabaseError, e:
+                    errors += [(item, e)]
+                else:
+                    pages += [page]
+
+    def bulk_save(self, pages, delete_stale=False):
+        '''
+        Write already processed pages to DB without fetching in one transaction.
+        Pages are upserted by unique key (lang, project, title) with INSERT ... ON CONFLICT
+        where DB supports it or with one query of existing pages, bulk_create of new ones and
+        updates of existing ones otherwise. Links to sister projects of pages are replaced together.
+        With delete_stale=True other pages of the same objects, projects and langs are deleted
+        with one statement. Signals are not sent, cached pages of objects are invalidated
+        '''
+        unique = {}
+        for page in pages:
+            unique[(page.lang, page.project_id, page.title)] = page
+        pages = unique.values()
+        if not pages:
+            return pages
+
+        sink = get_sink()
+        start = time.time()
+        with transaction.atomic():
+            if self._supports_upsert():
+                self._upsert(pages)
+            else:
+                self._insert_or_update(pages)
+            for page in pages:
+                page._state.adding = False
+                page._state.db = connection.alias
+                page._remember_values()
+
+            WikipageSisterLink.objects.bulk_replace(
+                [page for page in pages if page.__dict__.get('_sister_projects_changed')])
+
+            stale = [page for page in pages if page.object_id]
+            if delete_stale and stale:
+                self.filter(reduce(operator.or_, [
+                    Q(project=page.project_id, lang=page.lang, object_id=page.object_id,
+                      content_type=page.content_type_id) for page in stale
+                ])).exclude(id__in=[page.id for page in stale]).delete()
+
+        for content_type_id, object_id in set([(page.content_type_id, page.object_id) for page in pages]):
+            cache.invalidate_wikipage(self.model(content_type_id=content_type_id, object_id=object_id))
+
+        if sink is not None:
+            sink.timing('wikimedia.bulk_save', time.time() - start, pages=len(pages))
+        return pages
+
+    def _supports_upsert(self):
+        if connection.vendor == 'postgresql':
+            return connection.pg_version >= 90500
+        elif connection.vendor == 'sqlite':
+            return connection.Database.sqlite_version_info >= (3, 24)
+        return False
+
+    def _get_save_fields(self):
+        return [field for field in self.model._meta.concrete_fields if not field.primary_key]
+
+    def _upsert(self, pages):
+        '''
+        Insert pages or update existing ones with INSERT ... ON CONFLICT statements and set ids of pages
+        '''
+        quote_name = connection.ops.quote_name
+        fields = self._get_save_fields()
+        unique_columns = [self.model._meta.get_field(name).column for name in ('lang', 'project', 'title')]
+        columns = [field.column for field in fields]
+        returning = connection.vendor == 'postgresql'
+
+        sql = 'INSERT INTO %s (%s) VALUES %%s ON CONFLICT (%s) DO UPDATE SET %s' % (
+            quote_name(self.model._meta.db_table),
+            ', '.join([quote_name(column) for column in columns]),
+            ', '.join([quote_name(column) for column in unique_columns]),
+            ', '.join(['%s = EXCLUDED.%s' % (quote_name(column), quote_name(column))
+                       for column in columns if column not in unique_columns]))
+        if returning:
+            sql += ' RETURNING %s, %s' % (quote_name(self.model._meta.pk.column),
+                                          ', '.join([quote_name(column) for column in unique_columns]))
+
+        batch_size = max(1, connection.ops.bulk_batch_size(fields, pages))
+        with connection.cursor() as cursor:
+            for i in range(0, len(pages), batch_size):
+                batch = pages[i:i + batch_size]
+                params = []
+                for page in batch:
+                    params += [field.get_db_prep_save(field.pre_save(page, page.id is None), connection)
+                               for field in fields]
+                placeholders = '(%s)' % ', '.join(['%s'] * len(fields))
+                cursor.execute(sql % ', '.join([placeholders] * len(batch)), params)
+
+                if returning:
+                    ids = dict(((lang, project_id, title), id) for id, lang, project_id, title in cursor.fetchall())
+                    for page in batch:
+                        page.id = ids[(page.lang, page.project_id, page.title)]
+
+        if not returning:
+            self._set_ids(pages)
+
+    def _insert_or_update(self, pages):
+        '''
+        Update existing pages found with one query for every project and lang and bulk_create new ones
+        '''
+        existing = self._get_ids(pages)
+        fields = self._get_save_fields()
+        new_pages = []
+        for page in pages:
+            page.id = existing.get((page.lang, page.project_id, page.title))
+            if page.id is None:
+                new_pages += [page]
+            else:
+                self.filter(id=page.id).update(**dict((field.attname, field.pre_save(page, False))
+                                                       for field in fields))
+        if new_pages:
+            self.bulk_create(new_pages)
+            # ids are set by bulk_create only with some DB backends
+            self._set_ids([page for page in new_pages if page.id is None])
+
+    def _get_ids(self, pages):
+        '''
+        Return dict {(lang, project_id, title): id} of existing pages with one query for every project and lang
+        '''
+        titles = {}
+        for page in pages:
+            titles.setdefault((page.project_id, page.lang), []).append(page.title)
+
+        ids = {}
+        for (project_id, lang), project_titles in titles.items():
+            for i in range(0, len(project_titles), PREFETCH_CHUNK_SIZE):
+                for id, title in self.filter(project=project_id, lang=lang,
+                                             title__in=project_titles[i:i + PREFETCH_CHUNK_SIZE]) \
+                        .values_list('id', 'title'):
+                    ids[(lang, project_id, title)] = id
+        return ids
+
+    def _set_ids(self, pages):
+        ids = self._get_ids(pages)
+        for page in pages:
+            page.id = ids[(page.lang, page.project_id, page.title)]
 
     def get_language(self, lang):
         '''
@@ -120,7 +621,7 @@ class WikipageManager(models.Manager):
         if len(lang) != 2:
             raise ValueError('Attribute lang must be 2 symbols length')
 
-        if lang not in [l[0] for l in LANGUAGES]:
+        if lang not in LANGUAGE_CODES:
             raise ValueError('Attribute lang not in allowed settings.WIKIPEDIA_LANGUAGES')
 
         return lang
@@ -130,11 +631,56 @@ class WikipageManager(models.Manager):
         Get project by code and return instance
         '''
         try:
-            return Wikiproject.objects.get(code=project_code)
-        except:
+            return Wikiproject.objects.get_cached(project_code)
+        except Wikiproject.DoesNotExist:
             raise ValueError('There is no wikiproject for updating with code "%s"' % project_code)
 
 
+class WikiprojectManager(models.Manager):
+
+    '''
+    Wikiproject manager with in-process registry of all projects.
+    Registry is loaded with one query and invalidated on saving and deleting projects
+    '''
+    _registry = None
+
+    def get_registry(self):
+        '''
+        Return tuple of dicts: code -> project, domain -> project without language subdomain
+        and domain -> project with language subdomain
+        '''
+        registry = WikiprojectManager._registry
+        if registry is None:
+            by_code, by_domain, by_lang_domain = {}, {}, {}
+            for project in self.get_queryset():
+                by_code[project.code] = project
+                (by_lang_domain if project.subdomain_lang else by_domain).setdefault(project.domain, project)
+            registry = WikiprojectManager._registry = (by_code, by_domain, by_lang_domain)
+        return registry
+
+    def clear_registry(self, **kwargs):
+        WikiprojectManager._registry = None
+
+    def get_cached(self, code):
+        '''
+        Return project by code from registry
+        '''
+        try:
+            return self.get_registry()[0][code]
+        except KeyError:
+            raise self.model.DoesNotExist('There is no wikiproject with code "%s"' % code)
+
+    def get_by_domain(self, domain, lang):
+        '''
+        Return project with domain for specified lang from registry or None
+        '''
+        by_code, by_domain, by_lang_domain = self.get_registry()
+        if domain in by_domain:
+            return by_domain[domain]
+        elif domain.startswith(lang + '.'):
+            return by_lang_domain.get(domain[len(lang) + 1:])
+
+
 class Wikiproject(models.Model):
 
     '''
@@ -144,6 +690,8 @@ class Wikiproject(models.Model):
     domain = models.CharField(_('Domain'), max_length=50)
     subdomain_lang = models.BooleanField(_('Language subdomain'), default=False)
 
+    objects = WikiprojectManager()
+
     def get_domain(self, lang):
         return '%s.%s' % (lang, self.domain) if self.subdomain_lang else self.domain
 
@@ -160,15 +708,17 @@ class Wikipage(models.Model):
     lang = models.CharField(_('Language'), max_length=2, choices=LANGUAGES, db_index=True)
     project = models.ForeignKey(Wikiproject)
     title = models.CharField(_('Title'), max_length=300, db_index=True)
-    content = models.TextField(_('Content'))
+    content = CompressedTextField(_('Content'))
+    etag = models.CharField(_('ETag of last response'), max_length=100, blank=True, editable=False)
+    last_modified = models.CharField(_('Last-Modified of last response'), max_length=50, blank=True, editable=False)
+    revision = models.PositiveIntegerField(_('Revision id'), null=True, editable=False)
+    structure = models.TextField(_('Structure of content'), blank=True, editable=False)
     updated = models.DateTimeField(_('Date and time of last updating'), editable=False, auto_now=True, db_index=True)
 
     object_id = models.PositiveIntegerField(null=True)
     content_type = models.ForeignKey(ContentType, null=True, related_name='wikipages')
     content_object = GenericForeignKey()
 
-    sister_projects = []
-
     objects = WikipageManager()
 
     class Meta:
@@ -178,25 +728,222 @@ class Wikipage(models.Model):
 
     def save(self, *args, **kwargs):
         '''
-        Process wikipedia content before saving
+        Save page fetching and processing wikipedia content before saving according to fetch argument,
+        settings.WIKIMEDIA_FETCH_ON_SAVE by default: True - fetch before saving, False - only save,
+        'defer' - save and refresh page in background worker after commit of transaction.
+        Saving with update_fields without content never fetches. Page not modified since last fetching
+        saves only validators, timestamp and fields changed since loading
         '''
-        id = self.id
-        self.set_content()
+        fetch = kwargs.pop('fetch', None)
+        update_fields = kwargs.get('update_fields')
+        if fetch is None:
+            fetch = getattr(settings, 'WIKIMEDIA_FETCH_ON_SAVE', True) \
+                if update_fields is None or 'content' in update_fields else False
+
+        if fetch and fetch != 'defer' and not self.fetch_content() and self.id \
+                and not args and update_fields is None and not kwargs.get('force_insert'):
+            # page was not modified since last fetching => do not write content again
+            kwargs['update_fields'] = self._get_revalidated_fields()
+
+        sink = get_sink()
+        if sink is None:
+            super(Wikipage, self).save(*args, **kwargs)
+        else:
+            start = time.time()
+            super(Wikipage, self).save(*args, **kwargs)
+            sink.timing('wikimedia.save', time.time() - start, domain=self.get_domain())
+        self._remember_values()
+
+        if self.__dict__.get('_sister_projects_changed'):
+            WikipageSisterLink.objects.replace(self, self._sister_projects)
+            self._sister_projects_changed = False
+
+        if fetch == 'defer':
+            tasks.defer_refresh(self)
+
+    def _get_sister_projects(self):
+        if '_sister_projects' not in self.__dict__:
+            self._sister_projects = WikipageSisterLink.objects.get_for_pages([self]).get(self.id, []) \
+                if self.id else []
+        return self._sister_projects
+
+    def _set_sister_projects(self, value):
+        self._sister_projects = value
+        self._sister_projects_changed = True
+
+    # list of tuples (project_code, title) found by parser, persisted on saving
+    sister_projects = property(_get_sister_projects, _set_sister_projects)
+
+    def _get_images(self):
+        if '_images' not in self.__dict__:
+            self._images = self.get_images()
+        return self._images
+
+    def _set_images(self, value):
+        self._images = value
+
+    # list of tuples (url, text) of gallery found by parser, kept in structure
+    images = property(_get_images, _set_images)
 
+    def refresh(self, save=True):
+        '''
+        Fetch and process content of page and save it, page not modified since last fetching
+        is saved without content. Returns False if page was not modified
+        '''
+        modified = self.fetch_content()
+        if save:
+            self.save(fetch=False, update_fields=None if modified or not self.id else self._get_revalidated_fields())
+        return modified
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Wikipage, cls).from_db(db, field_names, values)
+        instance._remember_values()
+        return instance
+
+    def _remember_values(self):
+        '''
+        Remember values of loaded fields except content to find fields changed since loading or saving
+        '''
+        self._loaded_values = dict((field.attname, self.__dict__[field.attname])
+                                   for field in self._meta.concrete_fields
+                                   if field.name != 'content' and field.attname in self.__dict__)
+
+    def _get_revalidated_fields(self):
+        '''
+        Return names of fields saved for page not modified since last fetching: validators, timestamp
+        and fields changed since loading. All fields except content for page never loaded or saved
+        '''
+        loaded = self.__dict__.get('_loaded_values')
+        return [field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'content' and field.attname in self.__dict__ and (
+                    loaded is None or field.name in VALIDATOR_FIELDS or
+                    field.attname not in loaded or getattr(self, field.attname) != loaded[field.attname])]
+
+    def fetch_content(self):
+        '''
+        Get page content and process it without saving to DB.
+        Returns False if page was not modified since last fetching
+        '''
+        if not self.set_content():
+            return False
+
+        self.process_content()
+        return True
+
+    def process_content(self):
+        '''
+        Process fetched raw content with parser and extract its structure
+        '''
         if self.content:
             parser = get_parser()
-            self.content = parser.process_content(self.content, self)
+            sink = get_sink()
+            if sink is None:
+                self.content = parser.process_content(self.content, self)
+            else:
+                start = time.time()
+                self.content = parser.process_content(self.content, self)
+                sink.timing('wikimedia.process', time.time() - start, domain=self.get_domain(),
+                            parser=parser.__class__.__name__)
+            self.update_structure()
+
+    def update_structure(self):
+        '''
+        Extract structure of processed content: sections, links, images and sister projects
+        '''
+        self.structure = structure.dumps(structure.extract_structure(
+            self.content, self.get_domain(), self.sister_projects, self.images))
+        self.__dict__.pop('_structure_cache', None)
+
+    def get_structure(self):
+        '''
+        Return dict of structure of content, see structure.extract_structure
+        '''
+        if '_structure_cache' not in self.__dict__:
+            self._structure_cache = structure.loads(self.structure)
+        return self._structure_cache
+
+    def get_sections(self):
+        '''
+        Return list of sections (title, level) of content
+        '''
+        return [(title, level) for title, level, start, end in self.get_structure().get('sections', [])]
+
+    def get_section(self, title):
+        '''
+        Return html of section with title or lead part of content for title None or None if there is no section.
+        Deferred content is not loaded, section is taken from DB if content is not compressed
+        '''
+        page_structure = self.get_structure()
+        if title is None:
+            start, end = 0, page_structure.get('lead', 0)
+        else:
+            for section in page_structure.get('sections', []):
+                if section[0] == title:
+                    start, end = section[2:]
+                    break
+            else:
+                return None
+
+        if 'content' not in self.__dict__ and self.id:
+            prefix, section = Wikipage.objects.filter(id=self.id).annotate(
+                prefix=Substr('content', 1, len(COMPRESSED_PREFIX), output_field=models.TextField()),
+                section=Substr('content', start + 1, end - start, output_field=models.TextField()),
+            ).values_list('prefix', 'section')[0]
+            if prefix != COMPRESSED_PREFIX:
+                return section or u''
 
-        super(Wikipage, self).save(*args, **kwargs)
+        return self.content[start:end]
+
+    def get_links(self):
+        return self.get_structure().get('links', [])
+
+    def get_images(self):
+        return [tuple(image) for image in self.get_structure().get('images', [])]
 
     def set_content(self):
         '''
-        Get page content for current project and defina self.content model attribute
+        Get page content for current project and defina self.content model attribute.
+        Request is conditional if page was fetched before, returns False and leaves
+        self.content untouched if server responds page was not modified
         '''
+        response_store = get_store()
+        if response_store is not None and getattr(settings, 'WIKIMEDIA_RESPONSE_STORE_REPLAY', False):
+            response = response_store.get(self.get_url())
+            if response is not None:
+                self.etag = response.headers.get('etag', '')[:100]
+                self.last_modified = response.headers.get('last-modified', '')[:50]
+                self.revision = response.revision or self.revision
+                self.content = response.content
+                return True
+
+        if getattr(settings, 'WIKIMEDIA_USE_API', False):
+            modified = api.fetch_pages([self])[0]
+            if modified is None:
+                raise WikipageTitleError(self.get_title_error())
+            if modified:
+                self.store_response(self.revision)
+            return modified
+
         request = self._get_request()
 
-        response = urllib2.urlopen(request)
-        self.content = response.read()
+        response = get_transport().open(request)
+        if response.status == 304:
+            return False
+
+        self.etag = response.headers.get('etag', '')[:100]
+        self.last_modified = response.headers.get('last-modified', '')[:50]
+        self.content = response.content
+        self.store_response(headers=response.headers)
+        return True
+
+    def store_response(self, revision=None, headers=None):
+        '''
+        Keep fetched raw content in store of responses settings.WIKIMEDIA_RESPONSE_STORE if it is enabled
+        '''
+        response_store = get_store()
+        if response_store is not None:
+            response_store.put(self.get_url(), self.content, revision, headers)
 
     def get_domain(self):
         return self.project.get_domain(self.lang)
@@ -215,13 +962,15 @@ class Wikipage(models.Model):
         url = url_fix(url)
         return url
 
-    def _get_request(self):
+    def get_title_error(self):
+        return 'Incorrect %s title (%s) with lang "%s"' % (self.project.code, self.title.encode('utf-8'), self.lang)
+
+    def _get_headers(self):
 
-        headers = {
+        return {
             'User-Agent': 'Mozilla/5.0 (X11; U; Linux i686; ru; rv:1.9.1.8) Gecko/20100214 Linux Mint/8 (Helena) Firefox/3.5.8',
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
             'Accept-Language': 'ru,en-us;q=0.7,en;q=0.3',
-            'Accept-Encoding': 'deflate',
             'Accept-Charset': 'utf-8;q=0.7,*;q=0.7',
             'Keep-Alive': '300',
             'Connection': 'keep-alive',
@@ -229,4 +978,122 @@ class Wikipage(models.Model):
             'Cookie': 'users_info[check_sh_bool]=none; search_last_date=2010-02-19; search_last_month=2010-02; PHPSESSID=b6df76a958983da150476d9cfa0aab18',
         }
 
+    def _get_request(self):
+
+        headers = self._get_headers()
+
+        # conditional request for already fetched page
+        if self.id and self.content:
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+
         return urllib2.Request(url=self.get_url(), headers=headers)
+
+
+class WikipageSisterLinkManager(models.Manager):
+
+    '''
+    Manager of persisted links of wikipages to sister projects
+    '''
+
+    def get_for_pages(self, pages):
+        '''
+        Return dict {page id: [(project_code, title), ...]} of links of many pages or their ids
+        loaded with one query for every PREFETCH_CHUNK_SIZE pages
+        '''
+        ids = [getattr(page, 'id', page) for page in pages]
+        links = dict((id, []) for id in ids)
+        for i in range(0, len(ids), PREFETCH_CHUNK_SIZE):
+            queryset = self.filter(page__in=ids[i:i + PREFETCH_CHUNK_SIZE]).order_by('page', 'position')
+            for page_id, project_id, title in queryset.values_list('page', 'project', 'title'):
+                links[page_id] += [(project_id, title)]
+        return links
+
+    def prefetch(self, pages):
+        '''
+        Load links of many pages and set them as sister_projects of pages. Returns list of pages
+        '''
+        pages = list(pages)
+        links = self.get_for_pages([page for page in pages if page.id])
+        for page in pages:
+            page.__dict__['_sister_projects'] = links.get(page.id, [])
+        return pages
+
+    def get_linking_pages(self, project_code, titles):
+        '''
+        Return queryset of pages with links to titles of sister project
+        '''
+        return Wikipage.objects.filter(sister_links__project=project_code, sister_links__title__in=titles).distinct()
+
+    def replace(self, page, sister_projects):
+        '''
+        Replace links of page with list of tuples (project_code, title)
+        '''
+        links = self._get_links(page, sister_projects)
+        with transaction.atomic():
+            self.filter(page=page).delete()
+            if links:
+                self.bulk_create(links)
+
+    def bulk_replace(self, pages):
+        '''
+        Replace links of many saved pages with their sister_projects with one delete and one insert
+        '''
+        if not pages:
+            return
+        links = []
+        for page in pages:
+            links += self._get_links(page, page.sister_projects)
+            page._sister_projects_changed = False
+
+        with transaction.atomic():
+            ids = [page.id for page in pages]
+            for i in range(0, len(ids), PREFETCH_CHUNK_SIZE):
+                self.filter(page__in=ids[i:i + PREFETCH_CHUNK_SIZE]).delete()
+            if links:
+                self.bulk_create(links)
+
+    def _get_links(self, page, sister_projects):
+        links = []
+        seen = set()
+        for position, (project_code, title) in enumerate(sister_projects):
+            if (project_code, title) not in seen:
+                seen.add((project_code, title))
+                links += [WikipageSisterLink(page=page, project_id=project_code, title=title, position=position)]
+        return links
+
+
+class WikipageSisterLink(models.Model):
+
+    '''
+    Link of wikipage to page of sister project found by parser
+    '''
+    page = models.ForeignKey(Wikipage, related_name='sister_links')
+    project = models.ForeignKey(Wikiproject)
+    title = models.CharField(_('Title'), max_length=300)
+    position = models.PositiveSmallIntegerField(_('Position'), default=0)
+
+    objects = WikipageSisterLinkManager()
+
+    class Meta:
+        unique_together = ('page', 'project', 'title')
+        index_together = ('project', 'title')
+        ordering = ('page', 'position')
+
+    def __unicode__(self):
+        return '<WikipageSisterLink: %s %s>' % (self.project_id, self.title)
+
+
+def prefetch_wikipages(objects, projects=None, langs=None, fields=None):
+    '''
+    Load and cache wikipages of all objects of queryset or list, see WikipageManager.prefetch
+    '''
+    return Wikipage.objects.prefetch(objects, projects=projects, langs=langs, fields=fields)
+
+
+post_save.connect(Wikiproject.objects.clear_registry, sender=Wikiproject, weak=False)
+post_delete.connect(Wikiproject.objects.clear_registry, sender=Wikiproject, weak=False)
+post_save.connect(cache.invalidate_wikipage, sender=Wikipage)
+post_delete.connect(cache.invalidate_wikipage, sender=Wikipage)
@@ -1,8 +1,29 @@
 # -*- coding: utf-8 -*-
 from BeautifulSoup import BeautifulSoup, Comment, NavigableString
+from django.core.exceptions import ImproperlyConfigured
 import re
+import threading
+import time
 import urllib
 
+from metrics import get_sink
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError:
+    etree = None
+
+SISTER_PROJECT_URL = re.compile(r'^(?:http:)?//([^/]+)/wiki/(?:Special:Search/)?([^/\?]+)(?:\?.+)?$')
+SISTER_PROJECT_REF_CLASS = re.compile('wikiquote-ref|wikicommons-ref')
+SISTER_PROJECT_LINK_HREF = re.compile('^(?:http:)?//.+\.org/wiki/')
+SISTER_PROJECT_LINK_CLASS = re.compile('^(extiw|external text)$')
+THUMB_IMAGE_URL = re.compile(r'^(.+)thumb/(.+)/[^/]+')
+
+
+def count_removed(removed, rule):
+    removed[rule] = removed.get(rule, 0) + 1
+
 
 class WikipageGarbageRemove(object):
 
@@ -35,21 +56,185 @@ class WikipageGarbageRemove(object):
     audio = True
 
 
+class WikipageGarbageRules(object):
+
+    '''
+    Rules of removing garbage compiled from Remove settings for matching elements in one tree traversal.
+    Rules are immutable, use WikipageGarbageRules.compile(Remove) to get cached rules of Remove class
+    '''
+    _cache = {}
+
+    @classmethod
+    def compile(cls, remove):
+        '''
+        Return rules compiled once for Remove class
+        '''
+        rules = cls._cache.get(remove)
+        if rules is None:
+            rules = cls._cache[remove] = cls(remove)
+        return rules
+
+    def __init__(self, remove):
+        block_titles = list(remove.block_titles)
+        table_classes = list(remove.table_classes)
+        div_classes = list(remove.div_classes)
+        span_classes = list(remove.span_classes)
+        self.elements = {}  # tag name -> list of rules (label, (attribute, string or regexp) conditions)
+
+        # span editsection
+        if remove.edit_links:
+            self.add_rule('span', ('class', 'editsection'))
+
+        # table contents
+        if remove.contents:
+            self.add_rule('table', ('id', 'toc'), ('class', 'toc'))
+
+        # scripts
+        if remove.script:
+            self.add_rule('script')
+
+        # external links block (ru,en)
+        if remove.external_links:
+            block_titles += remove.external_links_titles
+
+        if remove.see_also:
+            block_titles += ['See also', u'См[^ ]+ также']
+
+        if remove.reference_links:
+            self.add_rule('sup', ('class', 'reference'))
+
+        if remove.reference:
+            # references block (en) div class="reflist references-column-count references-column-count-2"
+            div_classes += ['reflist', 'references-small']
+            block_titles += [u'Примечания', 'References', u'Источники', ]
+
+        if remove.infobox:
+            # sometimes there is another infoboxes on page http://ru.wikipedia.org/wiki/Король_говорит!
+            table_classes += ['infobox']
+            div_classes += ['infobox']
+
+        if remove.sisterproject:
+            # links to another wikimedia (en) table class="metadata mbox-small plainlinks"
+            table_classes += ['metadata']
+            # links to another wikimedia (ru) div class="infobox sisterproject noprint wikiquote-box"
+            div_classes += ['sisterproject', 'wikiquote-box']
+
+        if remove.navbox:
+            # links to another movies of director table class="navbox collapsible autocollapse nowraplinks"
+            table_classes += ['navbox', 'NavFrame']
+            # links to another cities of this region
+            table_classes += ['toccolours']
+            div_classes += ['navbox', 'NavFrame']
+
+        if remove.disambiguation:
+            # disambiguation div class="dablink" (en)
+            div_classes += ['dablink']
+
+        if remove.thumb_images:
+            div_classes += ['thumb']
+
+        if remove.audio:
+            span_classes += ['audiolink', 'audiolinkinfo']
+
+        # lock icon (en) <div class="metadata topicon" id="protected-icon">
+        self.add_rule('div', ('id', 'protected-icon'))
+        div_classes += ['metadata']
+
+        for name, classes in [('table', table_classes), ('div', div_classes), ('span', span_classes)]:
+            if classes:
+                self.add_rule(name, ('class', re.compile('(%s)' % '|'.join(classes))))
+
+        self.elements = dict((name, tuple(rules)) for name, rules in self.elements.items())
+        self.comments = remove.comments
+        self.block_titles = re.compile(u'(%s)' % u'|'.join(block_titles)) if block_titles else None
+        self.external_links_titles = re.compile(u'(%s)' % u'|'.join(remove.external_links_titles))
+        # the first infobox on page is removed together with everything before it (disambiguation)
+        self.infobox = re.compile('infobox') if remove.infobox or remove.disambiguation else None
+        self.remove_infobox = remove.infobox
+        self.remove_before_infobox = remove.disambiguation
+        # top level containers of audio players
+        self.audio_player = re.compile('^ogg_player_') if remove.audio else None
+        self.strip_attributes = (('style', 'bgcolor') if remove.style_attribute else ()) \
+            + (('class',) if remove.class_attribute else ())
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError('Compiled garbage rules are immutable')
+        super(WikipageGarbageRules, self).__setattr__(name, value)
+
+    def add_rule(self, name, *conditions):
+        label = name + ''.join(['[%s=%s]' % (attribute, getattr(test, 'pattern', test))
+                                for attribute, test in conditions])
+        self.elements.setdefault(name, []).append((label, conditions))
+
+    def match(self, name, get):
+        '''
+        Return label of the first rule matching element with tag name or None,
+        get returns attribute value of element
+        '''
+        for label, conditions in self.elements.get(name, ()):
+            for attribute, test in conditions:
+                value = get(attribute)
+                if value is None or not (test.search(value) if hasattr(test, 'search') else value == test):
+                    break
+            else:
+                return label
+        return None
+
+    def matches(self, name, get):
+        '''
+        Return True if element with tag name matches any rule, get returns attribute value of element
+        '''
+        return self.match(name, get) is not None
+
+
 class WikipageParserBase(object):
 
     '''
-    Common interface for wikipage parsers
+    Common interface for wikipage parsers.
+    Content and wikipage of processing are stored in thread locals, so one instance
+    of parser could be shared between threads
     '''
     class Remove(WikipageGarbageRemove):
         pass
 
-    content = None
-    wikipage = None
+    @property
+    def _local(self):
+        try:
+            return self.__dict__['_thread_local']
+        except KeyError:
+            return self.__dict__.setdefault('_thread_local', threading.local())
+
+    def _get_content(self):
+        return getattr(self._local, 'content', None)
+
+    def _set_content(self, value):
+        self._local.content = value
+
+    def _get_wikipage(self):
+        return getattr(self._local, 'wikipage', None)
+
+    def _set_wikipage(self, value):
+        self._local.wikipage = value
+
+    content = property(_get_content, _set_content)
+    wikipage = property(_get_wikipage, _set_wikipage)
 
     @property
     def remove(self):
         return self.Remove
 
+    @property
+    def rules(self):
+        return WikipageGarbageRules.compile(self.remove)
+
+    def get_removed(self):
+        '''
+        Return dict for counting elements removed by every rule if metrics are enabled or None
+        '''
+        return getattr(self._local, 'removed', None)
+
     def process_content(self, content, wikipage):
         '''
         Process wikipedia content before saving to DB
@@ -57,10 +242,27 @@ class WikipageParserBase(object):
         self.content = content
         self.wikipage = wikipage
 
-        self.parse_content()
-        self.remove_garbage()
-
-        return self.content
+        try:
+            sink = get_sink()
+            if sink is None:
+                self.parse_content()
+                self.remove_garbage()
+                return self.content
+
+            self._local.removed = {}
+            start = time.time()
+            self.parse_content()
+            parsed = time.time()
+            self.remove_garbage()
+            tags = dict(domain=wikipage.get_domain(), parser=self.__class__.__name__)
+            sink.timing('wikimedia.parse_content', parsed - start, **tags)
+            sink.timing('wikimedia.remove_garbage', time.time() - parsed, **tags)
+            for rule, count in self._local.removed.items():
+                sink.increment('wikimedia.remove_garbage.removed', count, domain=tags['domain'], rule=rule)
+            return self.content
+        finally:
+            # do not keep processed tree until the next page
+            self.content = self.wikipage = self._local.removed = None
 
     def parse_content(self):
         '''
@@ -74,6 +276,22 @@ class WikipageParserBase(object):
         '''
         pass
 
+    def get_sister_projects(self, project_urls):
+        '''
+        Return list with tuples (code, title) of registered projects for urls of sister projects
+        '''
+        projects = []
+        registry = self.wikipage.project.__class__.objects
+
+        for url in project_urls:
+            for domain, title in SISTER_PROJECT_URL.findall(url):
+                project = registry.get_by_domain(domain, self.wikipage.lang)
+                if project:
+                    title = urllib.unquote(title.encode('utf-8')).decode('utf-8')
+                    projects += [(project.code, title)]
+
+        return projects
+
 
 class WikipageParserBeautifulsoup(WikipageParserBase):
 
@@ -92,9 +310,10 @@ class WikipageParserBeautifulsoup(WikipageParserBase):
 
     def parse_content(self):
         '''
-        Parse wikipedia content for links to sister projects
+        Parse wikipedia content for links to sister projects and images of gallery
         '''
         self.parse_sister_projects()
+        self.wikipage.images = self.parse_wikicommons_images()
 
     def parse_sister_projects(self):
         '''
@@ -102,11 +321,8 @@ class WikipageParserBeautifulsoup(WikipageParserBase):
         '''
         self.wikipage.sister_projects = []  # important to make urls list empty
         project_urls = []
-        projects = []
-
-        registered_projects = self.wikipage.project.__class__.objects.all()
 
-        for item in self.find_block_contents(self.remove.external_links_titles, remove_strings=True):
+        for item in self.find_block_contents(self.rules.external_links_titles, remove_strings=True):
 
             # <table class="metadata plainlinks mbox-small"
             # <table class="metadata mbox-small plainlinks"
@@ -117,23 +333,16 @@ class WikipageParserBeautifulsoup(WikipageParserBase):
                     or item.name == 'div' and set(['infobox', 'sisterproject']).issubset(item_classes_set):
 
                 if self.wikipage.lang == 'ru':
-                    for link in item.findAll('span', {'class': re.compile('wikiquote-ref|wikicommons-ref')}):
+                    for link in item.findAll('span', {'class': SISTER_PROJECT_REF_CLASS}):
                         project_urls += [link.find('a')['href']]
 
                 elif self.wikipage.lang == 'en':
                     # http://en.wikiquote.org/wiki/Special:Search/The_Big_Lebowski
-                    for link in item.findAll('a', {'href': re.compile('^(?:http:)?//.+\.org/wiki/'), 'class': re.compile('^(extiw|external text)$')}):
+                    for link in item.findAll('a', {'href': SISTER_PROJECT_LINK_HREF, 'class': SISTER_PROJECT_LINK_CLASS}):
                         project_urls += [link['href']]
 
         # generate from found urls list with tuples (code, title)
-        for url in project_urls:
-            for domain, title in re.compile(r'^(?:http:)?//([^/]+)/wiki/(?:Special:Search/)?([^/\?]+)(?:\?.+)?$').findall(url):
-                for project in registered_projects:
-                    if domain == project.get_domain(self.wikipage.lang):
-                        title = urllib.unquote(title.encode('utf-8')).decode('utf-8')
-                        projects += [(project.code, title)]
-
-        self.wikipage.sister_projects = projects
+        self.wikipage.sister_projects = self.get_sister_projects(project_urls)
 
     def parse_wikicommons_images(self):
         '''
@@ -146,7 +355,7 @@ class WikipageParserBeautifulsoup(WikipageParserBase):
                 continue
             # http://upload.wikimedia.org/wikipedia/commons/thumb/4/45/Einst_4.jpg/83px-Einst_4.jpg
             # //upload.wikimedia.org/wikipedia/commons/4/45/Einst_4.jpg
-            image_url = re.sub(r'^(.+)thumb/(.+)/[^/]+', r'\1\2', img['src'])
+            image_url = THUMB_IMAGE_URL.sub(r'\1\2', img['src'])
             if image_url[0: 2] == '//':
                 image_url = 'http:' + image_url
             try:
@@ -159,124 +368,308 @@ class WikipageParserBeautifulsoup(WikipageParserBase):
 
     def remove_garbage(self):
         '''
-        Remove unnecessary tags from wikipedia content page
+        Remove unnecessary tags from wikipedia content page in one traversal of the tree
         '''
-        table_classes = self.remove.table_classes
-        div_classes = self.remove.div_classes
-        span_classes = self.remove.span_classes
+        rules = self.rules
+        state = {'infobox': rules.infobox is None, 'removed': self.get_removed()}
+        self.clean_children(self.content, rules, state, top_level=True)
 
-        # span editsection
-        if self.remove.edit_links:
-            [el.extract() for el in self.content.findAll('span', {'class': 'editsection'})]
+    def clean_element(self, el, rules, state):
+        '''
+        Remove garbage from element and its descendants.
+        Returns True if element contains audio player and it's top level container should be removed
+        '''
+        if not state['infobox'] and rules.infobox.search(el.get('class') or ''):
+            state['infobox'] = True
+            if rules.remove_before_infobox:
+                self.extract_previous(el)
+            if rules.remove_infobox:
+                el.extract()
+                if state['removed'] is not None:
+                    count_removed(state['removed'], 'infobox')
+                return False
+
+        if rules.audio_player and el.name == 'div' and rules.audio_player.search(el.get('id') or ''):
+            return True
+
+        rule = rules.match(el.name, el.get)
+        if rule is not None:
+            el.extract()
+            if state['removed'] is not None:
+                count_removed(state['removed'], rule)
+            return bool(rules.audio_player and el.find('div', {'id': rules.audio_player}))
+
+        for attribute in rules.strip_attributes:
+            if el.get(attribute) is not None:
+                del el[attribute]
+
+        return self.clean_children(el, rules, state)
+
+    def clean_children(self, parent, rules, state, top_level=False):
+        '''
+        Remove garbage from children of element, returns True if audio player was found inside
+        '''
+        player = False
+        block = False
+        for child in list(parent.contents):
+            if isinstance(child, NavigableString):
+                if block or rules.comments and isinstance(child, Comment):
+                    child.extract()
+                continue
 
-        # table contents
-        if self.remove.contents:
-            [el.extract() for el in self.content.findAll('table', {'id': 'toc', 'class': 'toc'})]
+            # h2 title with all next siblings until next h2 title
+            if child.name == 'h2' and rules.block_titles:
+                block = bool(child.find(text=rules.block_titles))
+
+            if block:
+                child.extract()
+                if state['removed'] is not None:
+                    count_removed(state['removed'], 'block')
+            elif self.clean_element(child, rules, state):
+                if top_level:
+                    # the whole top level container of audio player
+                    child.extract()
+                    if state['removed'] is not None:
+                        count_removed(state['removed'], 'audio_player')
+                else:
+                    player = True
+
+        return player
+
+    def extract_previous(self, el):
+        '''
+        Remove all tags before element except its parents
+        '''
+        while el:
+            for previous in el.findPreviousSiblings(True):
+                previous.extract()
+            el = el.parent
 
-        # scripts
-        if self.remove.script:
-            [el.extract() for el in self.content.findAll('script')]
+    def find_block_contents(self, titles, remove_strings=False):
+        '''
+        Find and return all block items with h2 title and all next tags siblings until next h2 title.
+        Titles is a list of regexps or compiled regexp
+        '''
+        if not hasattr(titles, 'search'):
+            titles = re.compile(u'(%s)' % u'|'.join(titles))
 
-        # remove all comments
-        if self.remove.comments:
-            [el.extract() for el in self.content.findAll(text=lambda text: isinstance(text, Comment))]
+        items = []
+        for title in self.content.findAll(text=titles):
+            # get h2
+            title = title.findParent('h2')
+            if not title:
+                continue
+            next = title.nextSibling
 
-        # external links block (ru,en)
-        if self.remove.external_links:
-            self.remove.block_titles += self.remove.external_links_titles
+            if not isinstance(title, NavigableString) or not remove_strings:
+                items += [title]
 
-        if self.remove.see_also:
-            self.remove.block_titles += ['See also', u'См[^ ]+ также']
+            while next and (isinstance(next, NavigableString) or next.name != 'h2'):
 
-        if self.remove.reference_links:
-            [el.extract() for el in self.content.findAll('sup', {'class': 'reference'})]
+                if not isinstance(next, NavigableString) or not remove_strings:
+                    items += [next]
 
-        if self.remove.reference:
-            # references block (en) div class="reflist references-column-count references-column-count-2"
-            div_classes += ['reflist', 'references-small']
-            self.remove.block_titles += [u'Примечания', 'References', u'Источники', ]
-
-        infobox = self.content.find(True, {'class': re.compile('infobox')})
-        if infobox:
-            if self.remove.disambiguation:
-                [el.extract() for el in infobox.findAllPrevious(True)]
-            if self.remove.infobox:
-                infobox.extract()
-                # sometimes there is another infoboxes on page http://ru.wikipedia.org/wiki/Король_говорит!
-                table_classes += ['infobox']
-                div_classes += ['infobox']
-
-        if self.remove.sisterproject:
-            # links to another wikimedia (en) table class="metadata mbox-small plainlinks"
-            table_classes += ['metadata']
-            # links to another wikimedia (ru) div class="infobox sisterproject noprint wikiquote-box"
-            div_classes += ['sisterproject', 'wikiquote-box']
+                next = next.nextSibling
 
-        if self.remove.navbox:
-            # links to another movies of director table class="navbox collapsible autocollapse nowraplinks"
-            table_classes += ['navbox', 'NavFrame']
-            # links to another cities of this region
-            table_classes += ['toccolours']
-            div_classes += ['navbox', 'NavFrame']
+        return items
 
-        if self.remove.disambiguation:
-            # disambiguation div class="dablink" (en)
-            div_classes += ['dablink']
 
-        if self.remove.thumb_images:
-            div_classes += ['thumb']
+if etree is not None:
+    CLASS_CONDITION = "contains(concat(' ', normalize-space(@class), ' '), ' %s ')"
 
-        if self.remove.audio:
-            set_parents = [el.findParents()[-2].extract()
-                           for el in self.content.findAll('div', {'id': re.compile('^ogg_player_')})]
-            span_classes += ['audiolink', 'audiolinkinfo']
+    XPATH = dict((name, etree.XPath(path)) for name, path in {
+        'h2': './/h2',
+        'span': './/span[@class]',
+        'link': './/a[@href][@class]',
+        'ogg_player': './/div[starts-with(@id, "ogg_player_")]',
+        'gallerybox': './/li[%s]' % (CLASS_CONDITION % 'gallerybox'),
+        'img': '(.//img)[1]',
+        'gallerytext': '(.//div[%s])[1]/descendant::p[1]' % (CLASS_CONDITION % 'gallerytext'),
+    }.items())
 
-        # lock icon (en) <div class="metadata topicon" id="protected-icon">
-        [el.extract() for el in self.content.findAll('div', {'id': 'protected-icon'})]
-        div_classes += ['metadata']
 
-        [el.extract() for el in self.content.findAll('table', {'class': re.compile('(%s)' % '|'.join(table_classes))})]
-        [el.extract() for el in self.content.findAll('div', {'class': re.compile('(%s)' % '|'.join(div_classes))})]
-        [el.extract() for el in self.content.findAll('span', {'class': re.compile('(%s)' % '|'.join(span_classes))})]
-        self.remove_blocks()
+class WikipageParserLxml(WikipageParserBase):
 
-        # remove all style attributes
-        if self.remove.style_attribute:
-            for el in self.content.findAll(style=True):
-                del el['style']
-            for el in self.content.findAll(bgcolor=True):
-                del el['bgcolor']
+    '''
+    Wikipage parser based on lxml library with precompiled XPath expressions.
+    Fast alternative for WikipageParserBeautifulsoup with the same results, except that
+    lxml serializer percent-encodes non-ASCII characters of href attributes
+    '''
 
-        if self.remove.class_attribute:
-            for el in self.content.findAll(True, {'class': True}):
-                del el['class']
+    def __init__(self):
+        if etree is None:
+            raise ImproperlyConfigured('lxml library is required for WikipageParserLxml')
 
-    def remove_blocks(self):
+    def process_content(self, content, wikipage):
         '''
-        Remove h2 title and all next tags siblings until next h2 title
+        Process wikipedia content before saving to DB
         '''
-        [el.extract() for el in self.find_block_contents(self.remove.block_titles)]
+        if isinstance(content, str):
+            content = content.decode('utf-8', 'replace')
+        content = lxml.html.fragment_fromstring(content, create_parent='div')
+        content = super(WikipageParserLxml, self).process_content(content, wikipage)
+        content = (content.text or '') + ''.join([lxml.html.tostring(el, encoding=unicode) for el in content])
+        return content.strip()
 
-    def find_block_contents(self, titles, remove_strings=False):
+    def parse_content(self):
         '''
-        Find and return all block items with h2 title and all next tags siblings until next h2 title
+        Parse wikipedia content for links to sister projects and images of gallery
         '''
-        items = []
-        for title in self.content.findAll(text=re.compile(u'(%s)' % u'|'.join(titles))):
-            # get h2
-            title = title.findParent('h2')
-            if not title:
+        self.parse_sister_projects()
+        self.wikipage.images = self.parse_wikicommons_images()
+
+    def parse_sister_projects(self):
+        '''
+        Parse wikipedia content for links to sister projects
+        '''
+        self.wikipage.sister_projects = []  # important to make urls list empty
+        project_urls = []
+
+        for item in self.find_block_contents(self.rules.external_links_titles, remove_strings=True):
+            item_classes_set = set(item.get('class', '').split())
+            if item.tag == 'table' and set(['plainlinks']).issubset(item_classes_set) \
+                    or item.tag == 'div' and set(['infobox', 'sisterproject']).issubset(item_classes_set):
+
+                if self.wikipage.lang == 'ru':
+                    for span in XPATH['span'](item):
+                        link = span.find('.//a') if SISTER_PROJECT_REF_CLASS.search(span.get('class')) else None
+                        if link is not None:
+                            project_urls += [link.get('href')]
+
+                elif self.wikipage.lang == 'en':
+                    # http://en.wikiquote.org/wiki/Special:Search/The_Big_Lebowski
+                    for link in XPATH['link'](item):
+                        if SISTER_PROJECT_LINK_HREF.search(link.get('href')) \
+                                and SISTER_PROJECT_LINK_CLASS.search(link.get('class')):
+                            project_urls += [link.get('href')]
+
+        # generate from found urls list with tuples (code, title)
+        self.wikipage.sister_projects = self.get_sister_projects(project_urls)
+
+    def parse_wikicommons_images(self):
+        '''
+        Parse and return images from wikicommons wikimedia's project
+        '''
+        images = []
+        for item in XPATH['gallerybox'](self.content):
+            img = XPATH['img'](item)
+            if not img:
                 continue
-            next = title.nextSibling
+            image_url = THUMB_IMAGE_URL.sub(r'\1\2', img[0].get('src'))
+            if image_url[0: 2] == '//':
+                image_url = 'http:' + image_url
+            text = XPATH['gallerytext'](item)
+            if not text:
+                image_text = ''
+            elif text[0].text or not len(text[0]):
+                image_text = text[0].text or ''
+            else:
+                image_text = lxml.html.tostring(text[0][0], encoding=unicode, with_tail=False)
+            images += [(image_url, image_text)]
 
-            if not isinstance(title, NavigableString) or not remove_strings:
-                items += [title]
+        return images
 
-            while next and (isinstance(next, NavigableString) or next.name != 'h2'):
+    def remove_garbage(self):
+        '''
+        Remove unnecessary tags from wikipedia content page in one traversal of the tree
+        '''
+        rules = self.rules
+        state = {'infobox': rules.infobox is None, 'removed': self.get_removed()}
+        self.clean_children(self.content, rules, state, top_level=True)
 
-                if not isinstance(next, NavigableString) or not remove_strings:
-                    items += [next]
+    def clean_element(self, el, rules, state):
+        '''
+        Remove garbage from element and its descendants.
+        Returns True if element contains audio player and it's top level container should be removed
+        '''
+        if not state['infobox'] and rules.infobox.search(el.get('class') or ''):
+            state['infobox'] = True
+            if rules.remove_before_infobox:
+                self.drop_previous(el)
+            if rules.remove_infobox:
+                el.drop_tree()
+                if state['removed'] is not None:
+                    count_removed(state['removed'], 'infobox')
+                return False
+
+        if rules.audio_player and el.tag == 'div' and rules.audio_player.search(el.get('id') or ''):
+            return True
+
+        rule = rules.match(el.tag, el.get)
+        if rule is not None:
+            el.drop_tree()
+            if state['removed'] is not None:
+                count_removed(state['removed'], rule)
+            return bool(rules.audio_player and XPATH['ogg_player'](el))
+
+        for attribute in rules.strip_attributes:
+            el.attrib.pop(attribute, None)
+
+        return self.clean_children(el, rules, state)
+
+    def clean_children(self, parent, rules, state, top_level=False):
+        '''
+        Remove garbage from children of element, returns True if audio player was found inside.
+        Text between tags is tail of previous tag and removed together with h2 blocks
+        '''
+        player = False
+        block = False
+        for child in list(parent):
+            if not isinstance(child.tag, basestring):
+                # comments and processing instructions
+                if block:
+                    parent.remove(child)
+                elif rules.comments:
+                    child.drop_tree()
+                continue
 
-                next = next.nextSibling
+            # h2 title with all next siblings until next h2 title
+            if child.tag == 'h2' and rules.block_titles:
+                block = bool(rules.block_titles.search(child.text_content()))
+
+            if block:
+                parent.remove(child)
+                if state['removed'] is not None:
+                    count_removed(state['removed'], 'block')
+            elif self.clean_element(child, rules, state):
+                if top_level:
+                    # the whole top level container of audio player
+                    child.drop_tree()
+                    if state['removed'] is not None:
+                        count_removed(state['removed'], 'audio_player')
+                else:
+                    player = True
+
+        return player
+
+    def drop_previous(self, el):
+        '''
+        Remove all tags before element except its parents
+        '''
+        while el is not None:
+            for previous in list(el.itersiblings(preceding=True)):
+                if isinstance(previous.tag, basestring):
+                    previous.drop_tree()
+            el = el.getparent()
+
+    def find_block_contents(self, titles, remove_strings=False):
+        '''
+        Find and return all block items with h2 title and all next tags siblings until next h2 title.
+        Text between tags is tail of items, comments are skipped with remove_strings=True.
+        Titles is a list of regexps or compiled regexp
+        '''
+        if not hasattr(titles, 'search'):
+            titles = re.compile(u'(%s)' % u'|'.join(titles))
+
+        items = []
+        for title in XPATH['h2'](self.content):
+            if not titles.search(title.text_content()):
+                continue
+            items += [title]
+            for el in title.itersiblings():
+                if el.tag == 'h2':
+                    break
+                if isinstance(el.tag, basestring) or not remove_strings:
+                    items += [el]
 
         return items
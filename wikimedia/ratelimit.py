@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+from email.utils import parsedate_tz, mktime_tz
+import json
+import os
+import threading
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    # Django 1.8
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
+
+__all__ = ['MAX_RETRY_AFTER', 'parse_retry_after', 'RateLimiter', 'FileRateLimiter', 'get_rate_limiter']
+
+MAX_RETRY_AFTER = 120  # maximum seconds of waiting requested by server
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    '''
+    Return shared rate limiter of requests per domain defined by settings.WIKIMEDIA_RATE_LIMIT
+    (requests per second, unlimited by default) and settings.WIKIMEDIA_RATE_LIMIT_BURST.
+    With settings.WIKIMEDIA_RATE_LIMIT_DIR limits are shared by all processes using the directory
+    '''
+    from django.conf import settings
+    rate = getattr(settings, 'WIKIMEDIA_RATE_LIMIT', None)
+    burst = getattr(settings, 'WIKIMEDIA_RATE_LIMIT_BURST', None)
+    directory = getattr(settings, 'WIKIMEDIA_RATE_LIMIT_DIR', None)
+    key = (rate, burst, directory)
+    if key not in _limiters:
+        with _limiters_lock:
+            if key not in _limiters:
+                _limiters[key] = FileRateLimiter(directory, rate, burst) if directory else RateLimiter(rate, burst)
+    return _limiters[key]
+
+
+def clear_rate_limiter_cache(setting=None, **kwargs):
+    if setting is None or setting.startswith('WIKIMEDIA_RATE_LIMIT'):
+        with _limiters_lock:
+            _limiters.clear()
+
+setting_changed.connect(clear_rate_limiter_cache)
+
+
+def parse_retry_after(value):
+    '''
+    Return seconds from value of Retry-After header in seconds or HTTP date format or None
+    '''
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        date = parsedate_tz(value)
+        if date is None:
+            return None
+        seconds = mktime_tz(date) - time.time()
+    return min(max(seconds, 0), MAX_RETRY_AFTER)
+
+
+class RateLimiter(object):
+
+    '''
+    Token bucket rate limiter of requests per domain shared by threads of process.
+    Every domain has bucket of burst tokens refilled with rate tokens per second,
+    requests are reserving tokens in advance and wait until their tokens are available.
+    Domain could be blocked for some time, for example by Retry-After header of response
+    '''
+
+    def __init__(self, rate=None, burst=None):
+        self.rate = float(rate) if rate else None
+        self.burst = float(burst or rate or 1)
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, domain):
+        '''
+        Wait until request to domain is allowed
+        '''
+        wait = self._update(domain, self._reserve)
+        if wait > 0:
+            time.sleep(wait)
+
+    def block(self, domain, seconds):
+        '''
+        Do not allow requests to domain for seconds
+        '''
+        until = time.time() + seconds
+
+        def block_state(state, now):
+            tokens, updated, blocked = state
+            return (tokens, updated, max(blocked, until)), None
+
+        self._update(domain, block_state)
+
+    def _reserve(self, state, now):
+        '''
+        Take one token from the bucket and return new state and seconds of waiting for the token
+        '''
+        tokens, updated, blocked = state
+        if self.rate is None:
+            return state, blocked - now
+
+        tokens = min(self.burst, tokens + (now - updated) * self.rate) - 1
+        wait = max(blocked - now, -tokens / self.rate)
+        return (tokens, now, blocked), wait
+
+    def _update(self, domain, func):
+        with self._lock:
+            now = time.time()
+            state, result = func(self._states.get(domain) or (self.burst, now, 0), now)
+            self._states[domain] = state
+        return result
+
+
+class FileRateLimiter(RateLimiter):
+
+    '''
+    Rate limiter keeping states of domains in files of directory locked with flock,
+    so limits are shared by all processes on the host
+    '''
+
+    def __init__(self, directory, rate=None, burst=None):
+        if fcntl is None:
+            raise ImproperlyConfigured('Sharing of rate limits between processes is not supported on this platform')
+        super(FileRateLimiter, self).__init__(rate, burst)
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _update(self, domain, func):
+        with self._lock:
+            with open(os.path.join(self.directory, '%s.json' % domain.replace(os.sep, '_')), 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    data = f.read()
+                    now = time.time()
+                    state, result = func(tuple(json.loads(data)) if data else (self.burst, now, 0), now)
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        return result
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+
+from django.db import connection, transaction
+
+import cache
+from checkpoint import load_checkpoint, save_checkpoint
+from models import Wikipage, Wikiproject, WikipageSisterLink
+from store import ResponseStore
+
+__all__ = ['reparse_page', 'WikipageReparse']
+
+
+def reparse_page(args):
+    '''
+    Process content of page with current parser settings. Runs in worker process without network
+    and DB access. Content is the current content of page with its sister projects and images
+    or None to take stored raw response. Returns tuple (id, content, structure, sister_projects)
+    or (id, None, None, None) if there is no stored response of page.
+    Sister projects are None if they should not be replaced
+    '''
+    directory, id, lang, title, project_code, content, sister_projects, images = args
+    page = Wikipage(id=id, lang=lang, title=title, project=Wikipage.objects.get_project(project_code))
+    if content is None:
+        response = ResponseStore(directory).get(page.get_url())
+        if response is None:
+            return id, None, None, None
+        page.content = response.content
+        # links persisted before are not loaded in worker process
+        page.__dict__['_sister_projects'] = []
+        page.process_content()
+        sister_projects = page._sister_projects if page.__dict__.get('_sister_projects_changed') else None
+        return id, page.content, page.structure, sister_projects
+
+    # sister projects and gallery are not found in already processed content without classes,
+    # so they are kept from the previous processing
+    page.content = content
+    page.process_content()
+    page.__dict__['_sister_projects'] = sister_projects
+    page.images = images
+    page.update_structure()
+    return id, page.content, page.structure, None
+
+
+class WikipageReparse(object):
+
+    '''
+    Reprocessing of existing wikipages with current parser settings by pool of processes,
+    parsing is CPU-bound, so it scales with number of cores. Pages are processed from stored raw
+    responses of directory or from their current content in DB if directory is None.
+    Pages are read by chunks of primary keys, the next chunk is parsed while results of the previous
+    one are written in one transaction. Id of the last written page is saved in JSON checkpoint file,
+    so interrupted reparse continues from the same point
+    '''
+    worker_chunksize = 10  # number of pages sent to worker process at once
+
+    def __init__(self, directory=None, processes=None, chunk_size=500, checkpoint=None):
+        self.directory = directory
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.checkpoint = checkpoint
+        self.state = load_checkpoint(self.checkpoint, {'last_id': 0})
+        self.count = 0
+        self.missing = 0
+
+    def get_chunks(self, queryset):
+        '''
+        Yield lists of pages of queryset after the last reparsed one by chunks of primary keys
+        '''
+        fields = ['id', 'lang', 'title', 'project', 'content_type', 'object_id']
+        if self.directory is None:
+            fields += ['content', 'structure']
+        queryset = queryset.only(*fields).order_by('id')
+
+        last_id = self.state['last_id']
+        while True:
+            pages = list(queryset.filter(id__gt=last_id)[:self.chunk_size].iterator())
+            if not pages:
+                break
+            if self.directory is None:
+                WikipageSisterLink.objects.prefetch(pages)
+            yield pages
+            last_id = pages[-1].id
+
+    def run(self, queryset, progress=None):
+        '''
+        Reparse pages of queryset, progress is called with numbers of processed and total pages after every chunk
+        '''
+        total = queryset.filter(id__gt=self.state['last_id']).count()
+        processed = 0
+
+        # registry of projects is loaded before forking, workers do not query DB
+        Wikiproject.objects.get_registry()
+        # workers must not share connection with parent
+        connection.close()
+
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            previous = None
+            for pages in self.get_chunks(queryset):
+                if self.directory is None:
+                    items = [(None, page.id, page.lang, page.title, page.project_id, page.content,
+                              page.sister_projects, page.images) for page in pages]
+                else:
+                    items = [(self.directory, page.id, page.lang, page.title, page.project_id, None, None, None)
+                             for page in pages]
+                result = pool.map_async(reparse_page, items, self.worker_chunksize)
+                if previous:
+                    processed += self.save(*previous)
+                    if progress:
+                        progress(processed, total)
+                previous = (pages, result)
+            if previous:
+                processed += self.save(*previous)
+                if progress:
+                    progress(processed, total)
+        finally:
+            pool.close()
+            pool.join()
+
+    def save(self, pages, result):
+        '''
+        Write results of parsing of chunk of pages in one transaction without touching updated field.
+        Returns number of pages of chunk
+        '''
+        objects = set()
+        with transaction.atomic():
+            for page, (id, content, structure, sister_projects) in zip(pages, result.get()):
+                if content is None:
+                    self.missing += 1
+                    continue
+                Wikipage.objects.filter(id=id).update(content=content, structure=structure)
+                if sister_projects is not None:
+                    WikipageSisterLink.objects.replace(page, sister_projects)
+                objects.add((page.content_type_id, page.object_id))
+                self.count += 1
+
+        for content_type_id, object_id in objects:
+            cache.invalidate_wikipage(Wikipage(content_type_id=content_type_id, object_id=object_id))
+
+        self.state['last_id'] = pages[-1].id
+        save_checkpoint(self.checkpoint, self.state)
+        return len(pages)
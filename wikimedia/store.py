@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import threading
+import zlib
+
+from transport import TransportResponse
+
+try:
+    # Django 1.8
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
+
+__all__ = ['StoredResponse', 'ResponseStore', 'get_store']
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store():
+    '''
+    Return shared store of raw responses in directory settings.WIKIMEDIA_RESPONSE_STORE
+    or None if raw responses are not stored
+    '''
+    from django.conf import settings
+    directory = getattr(settings, 'WIKIMEDIA_RESPONSE_STORE', None)
+    if directory is None:
+        return None
+    if directory not in _stores:
+        with _stores_lock:
+            if directory not in _stores:
+                _stores[directory] = ResponseStore(directory)
+    return _stores[directory]
+
+
+def clear_store_cache(setting=None, **kwargs):
+    if setting in (None, 'WIKIMEDIA_RESPONSE_STORE'):
+        with _stores_lock:
+            _stores.clear()
+
+setting_changed.connect(clear_store_cache)
+
+
+class StoredResponse(TransportResponse):
+
+    '''
+    Raw response read from store with revision of page, if it was known
+    '''
+
+    def __init__(self, url, status, headers, content, revision=None):
+        super(StoredResponse, self).__init__(url, status, headers, content)
+        self.revision = revision
+
+
+class ResponseStore(object):
+
+    '''
+    Store of raw responses on disk keyed by url and revision.
+    Contents are content-addressed by sha1 and compressed with zlib in files objects/xx/xxxx...,
+    so the same content of many revisions or urls is stored once. References are json files
+    refs/xx/xxxx... for every url and revision, the latest response of url has empty revision.
+    Files are replaced atomically, so store could be shared by many processes
+    '''
+    compress_level = 6
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def put(self, url, content, revision=None, headers=None):
+        '''
+        Store raw content of response of url and return its digest
+        '''
+        is_unicode = isinstance(content, unicode)
+        data = content.encode('utf-8') if is_unicode else content
+        digest = hashlib.sha1(data).hexdigest()
+
+        path = self._get_object_path(digest)
+        if not os.path.exists(path):
+            self._write(path, zlib.compress(data, self.compress_level))
+
+        ref = json.dumps({
+            'url': url,
+            'revision': revision,
+            'digest': digest,
+            'unicode': is_unicode,
+            'headers': headers or {},
+        })
+        if revision:
+            self._write(self._get_ref_path(url, revision), ref)
+        self._write(self._get_ref_path(url), ref)
+        return digest
+
+    def get(self, url, revision=None):
+        '''
+        Return StoredResponse of url with revision or the latest one or None if there is no response
+        '''
+        try:
+            with open(self._get_ref_path(url, revision)) as f:
+                ref = json.load(f)
+        except IOError:
+            return None
+
+        content = self.read(ref['digest'])
+        if ref['unicode']:
+            content = content.decode('utf-8')
+        return StoredResponse(url, 200, ref['headers'], content, ref['revision'])
+
+    def read(self, digest):
+        '''
+        Return raw content by digest, compressed file is mapped into memory instead of reading
+        '''
+        with open(self._get_object_path(digest), 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return zlib.decompress(data)
+            finally:
+                data.close()
+
+    def __contains__(self, url):
+        return os.path.exists(self._get_ref_path(url))
+
+    def _get_object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest[2:])
+
+    def _get_ref_path(self, url, revision=None):
+        key = u'%s\n%s' % (url, revision or '')
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, 'refs', digest[:2], digest[2:] + '.json')
+
+    def _write(self, path, data):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another process
+                if not os.path.isdir(directory):
+                    raise
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from HTMLParser import HTMLParser
+import json
+import re
+import urllib
+
+__all__ = ['extract_structure', 'dumps', 'loads']
+
+HEADING = re.compile(r'<h([2-6])(?:\s[^>]*)?>(.*?)</h\1\s*>', re.I | re.S)
+TAG = re.compile(r'<[^>]+>')
+WIKI_LINK = r'''<a\s[^>]*?href=["'](?:(?:https?:)?//%s)?/wiki/([^"'#?]+)'''
+
+_html_parser = HTMLParser()
+
+
+def get_text(html):
+    '''
+    Return text of html fragment without tags and entities
+    '''
+    return _html_parser.unescape(TAG.sub('', html)).strip()
+
+
+def get_sections(content):
+    '''
+    Return list of sections [title, level, start, end] of headings h2-h6 of content,
+    section spans from its heading until the next heading of the same or higher level
+    '''
+    sections = []
+    for match in HEADING.finditer(content):
+        level = int(match.group(1))
+        for section in reversed(sections):
+            if section[3] is not None:
+                continue
+            if section[1] >= level:
+                section[3] = match.start()
+        sections += [[get_text(match.group(2)), level, match.start(), None]]
+
+    for section in sections:
+        if section[3] is None:
+            section[3] = len(content)
+    return sections
+
+
+def get_links(content, domain):
+    '''
+    Return list of unique titles of wiki links of content to pages of domain
+    '''
+    links = []
+    seen = set()
+    for title in re.findall(WIKI_LINK % re.escape(domain), content, re.I):
+        title = _html_parser.unescape(title)
+        if isinstance(title, unicode):
+            title = title.encode('utf-8')
+        title = urllib.unquote(title).decode('utf-8', 'replace')
+        if title not in seen:
+            seen.add(title)
+            links += [title]
+    return links
+
+
+def extract_structure(content, domain, sister_projects=(), images=()):
+    '''
+    Return dict with structure of processed content of page:
+        lead - end offset of lead part before the first heading
+        sections - list of sections [title, level, start, end] with offsets in content
+        links - list of titles of wiki links to pages of the same domain
+        images - list of images [url, text] of gallery
+        sister_projects - list of [project_code, title] of sister projects
+    '''
+    sections = get_sections(content)
+    return {
+        'lead': sections[0][2] if sections else len(content),
+        'sections': sections,
+        'links': get_links(content, domain),
+        'images': [list(image) for image in images],
+        'sister_projects': [list(project) for project in sister_projects],
+    }
+
+
+def dumps(structure):
+    return json.dumps(structure, separators=(',', ':'), ensure_ascii=False)
+
+
+def loads(value):
+    return json.loads(value) if value else {}
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from checkpoint import load_checkpoint, save_checkpoint
+from models import Wikipage, WikipageTitleError
+import api
+
+__all__ = ['WikipageSync']
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+TITLES_CHUNK_SIZE = 500  # maximum number of titles in one query
+
+
+class WikipageSync(object):
+
+    '''
+    Incremental refreshing of wikipages: pages not updated longer than max_age and pages
+    changed in wikimedia according to recentchanges of their domains.
+    Progress of recentchanges polling is saved in JSON checkpoint file after every response,
+    so interrupted sync continues from the same point. Stale pages are resumable by themselves,
+    because updated field of every processed page is bumped
+    '''
+    stale_chunk_size = 1000  # number of stale pages loaded from DB at once
+
+    def __init__(self, max_age=None, checkpoint=None, chunk_size=None, concurrency=4, use_api=None):
+        self.max_age = max_age or timedelta(seconds=getattr(settings, 'WIKIMEDIA_SYNC_MAX_AGE', 60 * 60 * 24 * 7))
+        self.checkpoint = checkpoint or getattr(settings, 'WIKIMEDIA_SYNC_CHECKPOINT', None)
+        self.chunk_size = chunk_size or api.API_BATCH_SIZE
+        self.concurrency = concurrency
+        self.use_api = use_api
+        self.state = load_checkpoint(self.checkpoint, {'recentchanges': {}})
+        self.pages = []
+        self.errors = []
+
+    def get_stale_pages(self, limit=None):
+        '''
+        Return queryset of pages not updated longer than max_age, the oldest first
+        '''
+        queryset = Wikipage.objects.filter(updated__lt=timezone.now() - self.max_age).order_by('updated', 'id')
+        return queryset[:limit] if limit else queryset
+
+    def sync_stale(self, limit=None):
+        '''
+        Refresh not more than limit pages not updated longer than max_age, the oldest first.
+        Pages are loaded by chunks of stale_chunk_size after the last page of the previous chunk,
+        so pages failed to refresh are not loaded again
+        '''
+        queryset = self.get_stale_pages().select_related('project').only('title', 'lang', 'project', 'updated')
+        count = 0
+        last = None
+        while not limit or count < limit:
+            chunk = queryset
+            if last:
+                chunk = chunk.filter(Q(updated__gt=last.updated) | Q(updated=last.updated, id__gt=last.id))
+            size = min(self.stale_chunk_size, limit - count) if limit else self.stale_chunk_size
+            pages = list(chunk[:size])
+            if not pages:
+                break
+            self.refresh(pages)
+            count += len(pages)
+            last = pages[-1]
+
+    def sync_recent_changes(self):
+        '''
+        Refresh pages changed in wikimedia since last polling of recentchanges of every domain.
+        Domain is polled first time since max_age ago. Every response of recentchanges is processed
+        as soon as it arrives and its position is saved in checkpoint
+        '''
+        continues = self.state.setdefault('continue', {})
+        langs_projects = Wikipage.objects.order_by().values_list('lang', 'project').distinct()
+        for lang, project_code in langs_projects:
+            project = Wikipage.objects.get_project(project_code)
+            domain = project.get_domain(lang)
+            since = self.state['recentchanges'].get(domain) or \
+                (timezone.now() - self.max_age).strftime(TIMESTAMP_FORMAT)
+
+            for changes, continue_params in api.iter_recent_changes(domain, since, continues.get(domain)):
+                if changes:
+                    self.refresh(self.get_changed_pages(project, lang, [title for title, timestamp in changes]))
+                    self.state['recentchanges'][domain] = changes[-1][1]
+                if continue_params:
+                    continues[domain] = continue_params
+                else:
+                    continues.pop(domain, None)
+                save_checkpoint(self.checkpoint, self.state)
+
+    def get_changed_pages(self, project, lang, titles):
+        '''
+        Return list of known pages of project and lang with titles of recentchanges
+        '''
+        titles = list(set(titles) | set([title.replace(' ', '_') for title in titles]))
+        pages = []
+        for i in range(0, len(titles), TITLES_CHUNK_SIZE):
+            queryset = Wikipage.objects.filter(project=project, lang=lang, title__in=titles[i:i + TITLES_CHUNK_SIZE])
+            pages += list(queryset.select_related('project').only('title', 'lang', 'project', 'updated'))
+        return pages
+
+    def refresh(self, pages):
+        '''
+        Refresh pages by chunks alternating domains, requests to every domain are limited
+        by shared rate limiter of transport, see ratelimit.get_rate_limiter.
+        Pages not modified since last fetching and pages not found in wikimedia are marked as updated too
+        '''
+        domains = {}
+        for page in pages:
+            domains.setdefault(page.get_domain(), []).append(page)
+
+        chunks = []
+        for domain, domain_pages in domains.items():
+            chunks += [(i, domain, domain_pages[i:i + self.chunk_size])
+                       for i in range(0, len(domain_pages), self.chunk_size)]
+        chunks.sort(key=lambda chunk: chunk[0])
+
+        for i, domain, chunk in chunks:
+            pages, errors = Wikipage.objects.bulk_update([(page.title, page.lang, page.project_id) for page in chunk],
+                                                         concurrency=self.concurrency, use_api=self.use_api)
+            ids = dict(((page.title, page.lang, page.project_id), page.id) for page in chunk)
+            processed = [page.id for page in pages if page.id] + \
+                [ids.get(tuple(item)) for item, error in errors if isinstance(error, WikipageTitleError)]
+            Wikipage.objects.filter(id__in=processed).update(updated=timezone.now())
+            self.pages += pages
+            self.errors += errors
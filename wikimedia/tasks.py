@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+from importlib import import_module
+import hashlib
+import logging
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+
+try:
+    # Django 1.8
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
+
+__all__ = ['TaskTimeoutError', 'TaskFuture', 'Task', 'BaseExecutor', 'ThreadPoolExecutor', 'QueueExecutor',
+           'get_executor', 'run_task', 'run_queued_task', 'defer_refresh']
+
+logger = logging.getLogger(__name__)
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor():
+    '''
+    Return shared instance of task executor defined in settings.WIKIMEDIA_TASK_EXECUTOR
+    '''
+    from django.conf import settings
+    executor = getattr(settings, 'WIKIMEDIA_TASK_EXECUTOR', 'wikimedia.tasks.ThreadPoolExecutor')
+    if executor not in _executors:
+        with _executors_lock:
+            if executor not in _executors:
+                try:
+                    executor_path = executor.split('.')
+                    executor_module = import_module('.'.join(executor_path[:-1]))
+                    Executor = getattr(executor_module, executor_path[-1])
+                except (ImportError, AttributeError), e:
+                    raise ImproperlyConfigured('Error importing wikipage task executor %s: "%s"' % (executor, e))
+                _executors[executor] = Executor()
+
+    return _executors[executor]
+
+
+def clear_executor_cache(setting=None, **kwargs):
+    if setting is None or setting.startswith('WIKIMEDIA_TASK'):
+        with _executors_lock:
+            _executors.clear()
+
+setting_changed.connect(clear_executor_cache)
+
+
+class TaskTimeoutError(Exception):
+    pass
+
+
+class TaskFuture(object):
+
+    '''
+    Status and result of submitted task. Status is one of "pending", "running", "done", "failed"
+    or "queued" for tasks sent to external queue
+    '''
+
+    def __init__(self, status='pending'):
+        self.status = status
+        self.task_id = None
+        self._result = None
+        self._exception = None
+        self._event = threading.Event()
+
+    def __repr__(self):
+        return '<TaskFuture: %s>' % self.status
+
+    def done(self):
+        return self.status in ('done', 'failed')
+
+    def wait(self, timeout=None):
+        '''
+        Wait until task is done, returns False if it is not done after timeout
+        '''
+        self._event.wait(timeout)
+        return self.done()
+
+    def result(self, timeout=None):
+        '''
+        Return result of task or raise its exception
+        '''
+        if not self.wait(timeout):
+            raise TaskTimeoutError('Task is not done in %s seconds' % timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self.wait(timeout):
+            raise TaskTimeoutError('Task is not done in %s seconds' % timeout)
+        return self._exception
+
+    def set_running(self):
+        self.status = 'running'
+
+    def set_result(self, result):
+        self._result = result
+        self.status = 'done'
+        self._event.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self.status = 'failed'
+        self._event.set()
+
+
+class Task(object):
+
+    '''
+    Job of updating wikipage, payload is a dict serializable for external queues.
+    Key of task includes object and with_sister_projects, so tasks with other arguments are not coalesced
+    '''
+
+    def __init__(self, title, lang, project_code, domain, content_type_id=None, object_id=None,
+                 with_sister_projects=False):
+        self.key = (project_code, lang, title, content_type_id, object_id, with_sister_projects)
+        self.domain = domain
+        self.payload = dict(title=title, lang=lang, project_code=project_code, content_type_id=content_type_id,
+                            object_id=object_id, with_sister_projects=with_sister_projects)
+
+    def __repr__(self):
+        return '<Task: %s %s %s>' % (self.key[0], self.key[1], self.key[2].encode('utf-8'))
+
+
+class BaseExecutor(object):
+
+    '''
+    Common interface for executors of wikipage updating tasks.
+    Duplicate tasks for the same (project, lang, title) with the same object and with_sister_projects
+    are coalesced into one
+    '''
+
+    def submit_update(self, title, lang, project_code='wikipedia', object=None, with_sister_projects=False):
+        '''
+        Submit task of updating wikipage with arguments of WikipageManager.update and return TaskFuture
+        '''
+        from models import Wikipage
+        from django.contrib.contenttypes.models import ContentType
+
+        lang = Wikipage.objects.get_language(lang)
+        project = Wikipage.objects.get_project(project_code)
+        task = Task(title, lang, project.code, project.get_domain(lang),
+                    content_type_id=ContentType.objects.get_for_model(object).id if object else None,
+                    object_id=object.pk if object else None, with_sister_projects=with_sister_projects)
+        return self.submit(task)
+
+    def submit(self, task):
+        raise NotImplementedError
+
+
+class ThreadPoolExecutor(BaseExecutor):
+
+    '''
+    In-process executor with pool of daemon threads settings.WIKIMEDIA_TASK_WORKERS.
+    Not more than settings.WIKIMEDIA_TASK_DOMAIN_LIMIT tasks of the same domain are running at once
+    '''
+
+    def __init__(self):
+        from django.conf import settings
+        self.workers = getattr(settings, 'WIKIMEDIA_TASK_WORKERS', 4)
+        self.domain_limit = getattr(settings, 'WIKIMEDIA_TASK_DOMAIN_LIMIT', 2)
+        self._condition = threading.Condition()
+        self._pending = []
+        self._futures = {}
+        self._in_flight = {}
+        self._threads = []
+
+    def submit(self, task):
+        with self._condition:
+            future = self._futures.get(task.key)
+            if future is None:
+                future = self._futures[task.key] = TaskFuture()
+                self._pending.append((task, future))
+                self._start_threads()
+                self._condition.notify_all()
+        return future
+
+    def run(self, task):
+        return run_task(task.payload)
+
+    def _start_threads(self):
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        while len(self._threads) < min(self.workers, len(self._pending) + sum(self._in_flight.values())):
+            thread = threading.Thread(target=self._work, name='wikimedia-worker-%d' % len(self._threads))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _next(self):
+        for i, (task, future) in enumerate(self._pending):
+            if self._in_flight.get(task.domain, 0) < self.domain_limit:
+                del self._pending[i]
+                return task, future
+
+    def _work(self):
+        while True:
+            with self._condition:
+                job = self._next()
+                while job is None:
+                    self._condition.wait()
+                    job = self._next()
+                task, future = job
+                self._in_flight[task.domain] = self._in_flight.get(task.domain, 0) + 1
+                future.set_running()
+
+            try:
+                future.set_result(self.run(task))
+            except Exception, e:
+                logger.exception('Error of executing task %r', task)
+                future.set_exception(e)
+            finally:
+                # connection of worker thread is never reused between tasks
+                connection.close()
+                with self._condition:
+                    self._in_flight[task.domain] -= 1
+                    self._futures.pop(task.key, None)
+                    self._condition.notify_all()
+
+
+class QueueExecutor(BaseExecutor):
+
+    '''
+    Adapter for external task queues: subclass implements enqueue(payload) sending payload to queue
+    and returning id of job, worker of queue calls run_queued_task(payload).
+    Duplicate tasks are coalesced across processes with cache settings.WIKIMEDIA_TASK_CACHE
+    while task is in queue. Returned futures have status "queued"
+    '''
+    coalesce_timeout = 60 * 10
+
+    def submit(self, task):
+        future = TaskFuture('queued')
+        if get_task_cache().add(get_task_cache_key(task.payload), 1, self.coalesce_timeout):
+            future.task_id = self.enqueue(task.payload)
+        return future
+
+    def enqueue(self, payload):
+        raise NotImplementedError
+
+
+def get_task_cache():
+    from django.conf import settings
+    from django.core.cache import caches
+    return caches[getattr(settings, 'WIKIMEDIA_TASK_CACHE', 'default')]
+
+
+def get_task_cache_key(payload):
+    key = u'%(project_code)s:%(lang)s:%(title)s:%(content_type_id)s:%(object_id)s:%(with_sister_projects)s' % payload
+    return 'wikimedia:task:%s' % hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def run_task(payload):
+    '''
+    Update wikipage described by payload of task and return id of page.
+    Existing page is refreshed, new page and chain of sister projects are updated with WikipageManager.update
+    '''
+    from models import Wikipage
+    from django.contrib.contenttypes.models import ContentType
+
+    object = None
+    if payload.get('content_type_id'):
+        object = ContentType.objects.get_for_id(payload['content_type_id']) \
+            .get_object_for_this_type(pk=payload['object_id'])
+
+    if not payload.get('with_sister_projects'):
+        try:
+            page = Wikipage.objects.select_related('project') \
+                .get(project=payload['project_code'], lang=payload['lang'], title=payload['title'])
+        except Wikipage.DoesNotExist:
+            pass
+        else:
+            if object is not None:
+                page.content_type_id, page.object_id = payload['content_type_id'], object.pk
+            page.refresh()
+            return page.id
+
+    return Wikipage.objects.update(payload['title'], payload['lang'], payload['project_code'], object,
+                                   with_sister_projects=payload.get('with_sister_projects', False)).id
+
+
+def run_queued_task(payload):
+    '''
+    Entry point for workers of external queues, task could be queued again once it is started
+    '''
+    get_task_cache().delete(get_task_cache_key(payload))
+    return run_task(payload)
+
+
+def defer_refresh(page):
+    '''
+    Refresh wikipage with task executor after commit of current transaction
+    '''
+    def submit():
+        get_executor().submit_update(page.title, page.lang, page.project_id)
+
+    if hasattr(transaction, 'on_commit'):
+        # Django 1.9
+        transaction.on_commit(submit)
+    else:
+        submit()
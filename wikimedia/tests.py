@@ -1,7 +1,43 @@
 # -*- coding: utf-8 -*-
 from django.test import TestCase
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.db import connection
+from django.core.management import call_command
 from django.conf import settings
-from models import Wikipage
+from models import Wikipage, Wikiproject, WikipageSisterLink, WikipageTitleError, get_parser, clear_wikipages_cache, \
+    prefetch_wikipages
+from django.contrib.contenttypes.models import ContentType
+from parsers import WikipageGarbageRules, WikipageParserBase, WikipageParserBeautifulsoup, WikipageParserLxml, etree
+from transport import BaseTransport, PooledTransport
+from ratelimit import RateLimiter, FileRateLimiter, parse_retry_after
+import shutil
+from sync import WikipageSync
+from datetime import timedelta
+from django.utils import timezone
+import json
+import api
+import tempfile
+import threading
+import time
+import cache
+import metrics
+import benchmark
+import tasks
+from store import ResponseStore
+from fields import COMPRESSED_PREFIX
+from BeautifulSoup import BeautifulSoup
+from multiprocessing.pool import ThreadPool
+import gzip
+import httplib
+import os
+import re
+import StringIO
+import unittest
+import urllib
+import urllib2
+import zlib
+
+TESTDATA_DIR = os.path.join(os.path.dirname(__file__), 'testdata')
 
 setattr(settings, 'WIKIMEDIA_LANGUAGES', [('en', ''),('ru', '')])
 delattr(settings, 'WIKIMEDIA_PARSER')
@@ -142,4 +178,1111 @@ class WikimediaTestCase(TestCase):
         self.assertTrue(ru.content.find(u'ogg_player_3') == -1)
 
         ru = Wikipage.objects.update(u'Титаник_(фильм,_1997)', 'ru')
-        self.assertTrue(ru.content.find(u'См. также') == -1)
\ No newline at end of file
+        self.assertTrue(ru.content.find(u'См. также') == -1)
+
+
+class WikimediaTransportTestCase(TestCase):
+
+    def test_decode(self):
+        '''Test of decoding compressed responses'''
+        content = u'<p>Ковер задавал стиль всей комнате</p>'.encode('utf-8')
+        transport = BaseTransport()
+
+        buffer = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=buffer, mode='wb') as file:
+            file.write(content)
+
+        self.assertEqual(transport.decode(buffer.getvalue(), 'gzip'), content)
+        self.assertEqual(transport.decode(zlib.compress(content), 'deflate'), content)
+        self.assertEqual(transport.decode(zlib.compress(content)[2:-4], 'deflate'), content)
+        self.assertEqual(transport.decode(content, ''), content)
+        self.assertRaises(ValueError, transport.decode, content, 'br')
+
+    @override_settings(WIKIMEDIA_RETRIES=0)
+    def test_stale_connection(self):
+        '''Test of repeating request at once on a new connection if pooled one was closed by server'''
+        class Response(object):
+            status, reason, will_close = 200, 'OK', False
+
+            def getheaders(self):
+                return []
+
+            def read(self):
+                return 'Content'
+
+        class Connection(object):
+            def __init__(self, stale=False):
+                self.stale = stale
+                self.closed = False
+
+            def request(self, method, path, headers):
+                pass
+
+            def getresponse(self):
+                if self.stale:
+                    raise httplib.BadStatusLine('')
+                return Response()
+
+            def close(self):
+                self.closed = True
+
+        transport = PooledTransport()
+        stale, fresh = Connection(stale=True), Connection()
+        transport._pools[('http', 'en.wikipedia.org')] = [stale]
+        transport._new_connection = lambda scheme, host: fresh
+
+        # without retries request succeeds only with repeating on a new connection
+        response = transport.open(urllib2.Request('http://en.wikipedia.org/wiki/Page'))
+        self.assertEqual(response.content, 'Content')
+        self.assertTrue(stale.closed)
+        self.assertEqual(transport._pools[('http', 'en.wikipedia.org')], [fresh])
+
+        # failure of new connection is not repeated
+        fresh.stale = True
+        transport._pools[('http', 'en.wikipedia.org')] = []
+        self.assertRaises(httplib.BadStatusLine, transport.open, urllib2.Request('http://en.wikipedia.org/wiki/Page'))
+
+
+class StaticTransport(BaseTransport):
+
+    '''
+    Transport returning responses from list of tuples (url substring, status, content[, headers]) of class.
+    Made requests are recorded as tuples (url, headers)
+    '''
+    responses = []
+    requests = []
+
+    def _request(self, url, headers):
+        self.requests.append((url, headers))
+        for response in self.responses:
+            substring, status, content, response_headers = (tuple(response) + ({},))[:4]
+            if substring in url:
+                return status, 'OK', dict(response_headers), content
+        return 404, 'Not Found', {}, ''
+
+
+@override_settings(WIKIMEDIA_TRANSPORT='wikimedia.tests.StaticTransport', WIKIMEDIA_USE_API=False, WIKIMEDIA_RETRIES=0)
+class WikipageSyncTestCase(TestCase):
+
+    fixtures = ['initial_data']
+
+    def test_sync(self):
+        '''Test of refreshing stale and recently changed pages'''
+        project = Wikipage.objects.get_project('wikipedia')
+        for title in ['Stale', 'Fresh', 'Changed', 'Deleted', 'Unavailable']:
+            Wikipage(lang='en', project=project, title=title, content='<p>Old</p>').save(fetch=False)
+        Wikipage.objects.filter(title__in=['Stale', 'Deleted', 'Unavailable']) \
+            .update(updated=timezone.now() - timedelta(days=2))
+
+        StaticTransport.responses = [
+            ('list=recentchanges', 200, json.dumps({'query': {'recentchanges': [
+                {'title': 'Changed', 'timestamp': '2015-10-13T21:56:00Z'},
+                {'title': 'Unknown', 'timestamp': '2015-10-13T21:57:00Z'},
+            ]}})),
+            ('title=Stale', 200, '<p>New</p>'),
+            ('title=Changed', 200, '<p>New</p>'),
+            ('title=Unavailable', 503, ''),
+        ]
+
+        checkpoint = tempfile.NamedTemporaryFile(suffix='.json', delete=False).name
+        os.unlink(checkpoint)
+        try:
+            sync = WikipageSync(max_age=timedelta(days=1), checkpoint=checkpoint)
+            sync.sync_recent_changes()
+            sync.sync_stale()
+            with open(checkpoint) as f:
+                self.assertEqual(json.load(f), {'recentchanges': {'en.wikipedia.org': '2015-10-13T21:57:00Z'},
+                                                'continue': {}})
+        finally:
+            if os.path.exists(checkpoint):
+                os.unlink(checkpoint)
+
+        contents = dict(Wikipage.objects.values_list('title', 'content'))
+        self.assertEqual(contents, {'Stale': '<p>New</p>', 'Fresh': '<p>Old</p>', 'Changed': '<p>New</p>',
+                                    'Deleted': '<p>Old</p>', 'Unavailable': '<p>Old</p>'})
+        errors = dict((item[0], error) for item, error in sync.errors)
+        self.assertEqual(sorted(errors), [u'Deleted', u'Unavailable'])
+        self.assertTrue(isinstance(errors['Deleted'], WikipageTitleError))
+        self.assertEqual(errors['Unavailable'].code, 503)
+
+        # page not found is not stale anymore, page failed to fetch is retried next time
+        self.assertEqual([page.title for page in sync.get_stale_pages()], [u'Unavailable'])
+
+    def test_sync_resume(self):
+        '''Test of saving position of recentchanges after every response and resuming from it'''
+        project = Wikipage.objects.get_project('wikipedia')
+        for title in ['First', 'Second']:
+            Wikipage(lang='en', project=project, title=title, content='<p>Old</p>').save(fetch=False)
+
+        first = ('list=recentchanges', 200, json.dumps({
+            'query': {'recentchanges': [{'title': 'First', 'timestamp': '2015-10-13T21:56:00Z'}]},
+            'continue': {'rccontinue': '20151013215700|2', 'continue': '-||'},
+        }))
+        second = ('rccontinue=20151013215700', 200, json.dumps({
+            'query': {'recentchanges': [{'title': 'Second', 'timestamp': '2015-10-13T21:57:00Z'}]},
+        }))
+        pages = [('title=First', 200, '<p>New</p>'), ('title=Second', 200, '<p>New</p>')]
+
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'checkpoint.json')
+        try:
+            # polling is interrupted by failed second response
+            StaticTransport.responses = [('rccontinue=20151013215700', 500, '')] + [first] + pages
+            sync = WikipageSync(max_age=timedelta(days=1), checkpoint=checkpoint)
+            self.assertRaises(urllib2.HTTPError, sync.sync_recent_changes)
+            with open(checkpoint) as f:
+                self.assertEqual(json.load(f), {
+                    'recentchanges': {'en.wikipedia.org': '2015-10-13T21:56:00Z'},
+                    'continue': {'en.wikipedia.org': {'rccontinue': '20151013215700|2', 'continue': '-||'}},
+                })
+            self.assertEqual(Wikipage.objects.get(title='First').content, '<p>New</p>')
+            self.assertEqual(Wikipage.objects.get(title='Second').content, '<p>Old</p>')
+
+            # the first response is not requested again
+            StaticTransport.responses = [second] + pages
+            sync = WikipageSync(max_age=timedelta(days=1), checkpoint=checkpoint)
+            sync.sync_recent_changes()
+            self.assertEqual([page.title for page in sync.pages], [u'Second'])
+            with open(checkpoint) as f:
+                self.assertEqual(json.load(f), {'recentchanges': {'en.wikipedia.org': '2015-10-13T21:57:00Z'},
+                                                'continue': {}})
+        finally:
+            shutil.rmtree(os.path.dirname(checkpoint))
+
+    def test_sync_stale_chunks(self):
+        '''Test of refreshing the oldest stale pages by chunks'''
+        project = Wikipage.objects.get_project('wikipedia')
+        titles = ['Page_1', 'Unavailable', 'Page_2', 'Page_3', 'Page_4']
+        for i, title in enumerate(titles):
+            page = Wikipage(lang='en', project=project, title=title, content='<p>Old</p>')
+            page.save(fetch=False)
+            Wikipage.objects.filter(id=page.id).update(updated=timezone.now() - timedelta(days=10 - i))
+
+        StaticTransport.responses = [('title=Unavailable', 503, ''), ('en.wikipedia.org', 200, '<p>New</p>')]
+        sync = WikipageSync(max_age=timedelta(days=1))
+        sync.stale_chunk_size = 2
+        chunks = []
+        refresh = sync.refresh
+
+        def record_chunk(pages):
+            chunks.append([page.title for page in pages])
+            return refresh(pages)
+
+        sync.refresh = record_chunk
+        sync.sync_stale(limit=4)
+
+        self.assertEqual(chunks, [['Page_1', 'Unavailable'], ['Page_2', 'Page_3']])
+        self.assertEqual([page.title for page in sync.get_stale_pages()], [u'Unavailable', u'Page_4'])
+
+
+@override_settings(WIKIMEDIA_TRANSPORT='wikimedia.tests.StaticTransport', WIKIMEDIA_USE_API=False)
+class WikipageChainTestCase(TestCase):
+
+    fixtures = ['initial_data']
+
+    def test_update_chain(self):
+        '''Test of updating chain of sister projects for object'''
+        with open(os.path.join(TESTDATA_DIR, 'en_easy_rider.html')) as f:
+            StaticTransport.responses = [
+                ('en.wikipedia.org', 200, f.read(), {'etag': '"1"'}),
+                ('en.wikiquote.org', 200, '<p>Quotes</p>'),
+            ]
+
+        project = Wikipage.objects.get_project('wikinews')
+        object = Wikipage(lang='ru', project=project, title='Object', content='Object')
+        object.save(fetch=False)
+        Wikipage(lang='en', project=project, title='Old', content='<p>Old</p>', object_id=object.id,
+                 content_type=ContentType.objects.get_for_model(object)).save(fetch=False)
+
+        page = Wikipage.objects.update('Easy_Rider', 'en', object=object, with_sister_projects=True)
+        # page of wikicommons is not found
+        self.assertEqual(page.sister_projects, [('wikiquote', u'Easy_Rider'), ('wikicommons', u'Easy_Rider')])
+        self.assertEqual(sorted(Wikipage.objects.for_object(object).values_list('project', 'title')),
+                         [(u'wikipedia', u'Easy_Rider'), (u'wikiquote', u'Easy_Rider')])
+        self.assertEqual(Wikipage.objects.for_object(object).wikiquote_en, '<p>Quotes</p>')
+        content = Wikipage.objects.get(id=page.id).content
+
+        # page not modified since last fetching follows its stored links to sister projects
+        Wikipage.objects.filter(project='wikiquote').delete()
+        StaticTransport.responses = [('en.wikipedia.org', 304, ''), ('en.wikiquote.org', 200, '<p>New quotes</p>')]
+        StaticTransport.requests = []
+        page = Wikipage.objects.update('Easy_Rider', 'en', object=object, with_sister_projects=True)
+        self.assertEqual([headers.get('If-none-match') for url, headers in StaticTransport.requests
+                          if 'en.wikipedia.org' in url], ['"1"'])
+        self.assertEqual(Wikipage.objects.get(id=page.id).content, content)
+        self.assertEqual(Wikipage.objects.for_object(object).wikiquote_en, '<p>New quotes</p>')
+
+        # fan out limit
+        Wikipage.objects.filter(project='wikiquote').delete()
+        Wikipage.objects.update('Easy_Rider', 'en', object=object, with_sister_projects=True, max_fan_out=0)
+        self.assertEqual(Wikipage.objects.for_object(object).count(), 1)
+
+
+@override_settings(WIKIMEDIA_TRANSPORT='wikimedia.tests.StaticTransport', WIKIMEDIA_USE_API=False)
+class WikipageRevalidationTestCase(TestCase):
+
+    fixtures = ['initial_data']
+
+    def get_updated_columns(self, queries):
+        '''Return set of columns of UPDATE queries of wikipages'''
+        columns = set()
+        for query in queries:
+            if query['sql'].startswith('UPDATE "wikimedia_wikipage"'):
+                columns |= set(re.findall(r'"(\w+)" = ', query['sql'].split(' WHERE ')[0]))
+        return columns
+
+    def test_revalidation(self):
+        '''Test of revalidating fetched page with conditional request'''
+        StaticTransport.responses = [('en.wikipedia.org', 200, '<p>Fetched</p>',
+                                      {'etag': '"1"', 'last-modified': 'Tue, 13 Oct 2015 21:56:00 GMT'})]
+        page = Wikipage(lang='en', project=Wikipage.objects.get_project('wikipedia'), title='Easy_Rider')
+        page.save()
+        self.assertEqual((page.etag, page.last_modified), ('"1"', 'Tue, 13 Oct 2015 21:56:00 GMT'))
+
+        page = Wikipage.objects.get(id=page.id)
+        updated = page.updated
+        StaticTransport.responses = [('en.wikipedia.org', 304, '')]
+        StaticTransport.requests = []
+
+        def process_content():
+            self.fail('Content not modified is parsed')
+        page.process_content = process_content
+
+        with CaptureQueriesContext(connection) as queries:
+            page.save()
+
+        headers = StaticTransport.requests[0][1]
+        self.assertEqual(headers['If-none-match'], '"1"')
+        self.assertEqual(headers['If-modified-since'], 'Tue, 13 Oct 2015 21:56:00 GMT')
+        self.assertEqual(page.content, '<p>Fetched</p>')
+        self.assertEqual(self.get_updated_columns(queries), set(['etag', 'last_modified', 'revision', 'updated']))
+        self.assertEqual(Wikipage.objects.get(id=page.id).content, '<p>Fetched</p>')
+        self.assertTrue(Wikipage.objects.get(id=page.id).updated > updated)
+
+        # fields changed since loading are saved too
+        page.object_id = 1
+        with CaptureQueriesContext(connection) as queries:
+            self.assertFalse(page.refresh())
+        self.assertEqual(self.get_updated_columns(queries),
+                         set(['etag', 'last_modified', 'revision', 'updated', 'object_id']))
+        self.assertEqual(Wikipage.objects.get(id=page.id).object_id, 1)
+
+
+@override_settings(WIKIMEDIA_TRANSPORT='wikimedia.tests.StaticTransport', WIKIMEDIA_USE_API=False, WIKIMEDIA_RETRIES=0)
+class WikipageBulkUpdateTestCase(TestCase):
+
+    fixtures = ['initial_data']
+
+    def test_bulk_update(self):
+        '''Test of saving pages by batches and reporting errors of every item'''
+        StaticTransport.responses = [
+            ('Unavailable', 503, ''),
+            ('en.wikipedia.org', 200, '<p>Fetched</p>'),
+        ]
+        batches = []
+        save_batch = Wikipage.objects._save_batch
+
+        def record_batch(batch, pages, errors):
+            batches.append(len(batch))
+            return save_batch(batch, pages, errors)
+
+        Wikipage.objects._save_batch = record_batch
+        try:
+            pages, errors = Wikipage.objects.bulk_update([
+                ('Page_1', 'en'),
+                ('Page_2', 'en'),
+                ('Page_3', 'en'),
+                ('Missing', 'ru'),
+                ('Unavailable', 'en'),
+                ('Page_1', 'de'),
+                ('Page_1', 'en', 'wikiunknown'),
+            ], concurrency=2, batch_size=2)
+        finally:
+            del Wikipage.objects._save_batch
+
+        self.assertEqual(batches, [2, 1])
+        self.assertEqual(sorted([page.title for page in pages]), ['Page_1', 'Page_2', 'Page_3'])
+        self.assertEqual(Wikipage.objects.count(), 3)
+        errors = dict(errors)
+        self.assertEqual(len(errors), 4)
+        self.assertTrue(isinstance(errors[('Missing', 'ru')], WikipageTitleError))
+        self.assertEqual(errors[('Unavailable', 'en')].code, 503)
+        self.assertTrue(isinstance(errors[('Page_1', 'de')], ValueError))
+        self.assertTrue(isinstance(errors[('Page_1', 'en', 'wikiunknown')], ValueError))
+
+    @override_settings(WIKIMEDIA_USE_API=True)
+    def test_bulk_update_api(self):
+        '''Test of fetching pages by batches of api.php requests per domain'''
+        def get_response(title):
+            return {'query': {'pages': {'1': {'title': title, 'revisions': [{'revid': 1, '*': '<p>Fetched</p>'}]}}}}
+
+        StaticTransport.responses = [('titles=%s' % title, 200, json.dumps(get_response(title)))
+                                     for title in ['Page_1', 'Page_2', 'Page_3']]
+        StaticTransport.responses += [('titles=Missing', 200,
+                                       json.dumps({'query': {'pages': {'-1': {'title': 'Missing', 'missing': ''}}}}))]
+        StaticTransport.requests = []
+        api_batch_size = api.API_BATCH_SIZE
+        api.API_BATCH_SIZE = 1
+        try:
+            pages, errors = Wikipage.objects.bulk_update([
+                ('Page_1', 'en'),
+                ('Page_2', 'en'),
+                ('Page_3', 'ru'),
+                ('Missing', 'en'),
+            ], concurrency=2)
+
+            self.assertEqual(len(StaticTransport.requests), 4)
+            self.assertEqual(sorted([page.title for page in pages]), ['Page_1', 'Page_2', 'Page_3'])
+            self.assertTrue(all([page.revision == 1 for page in pages]))
+            self.assertEqual([item for item, error in errors], [('Missing', 'en')])
+            self.assertTrue(isinstance(errors[0][1], WikipageTitleError))
+
+            # all revisions are the same => only revisions are requested and nothing is saved
+            updated = [page.updated for page in Wikipage.objects.order_by('id')]
+            StaticTransport.requests = []
+            pages, errors = Wikipage.objects.bulk_update([(page.title, page.lang) for page in pages])
+        finally:
+            api.API_BATCH_SIZE = api_batch_size
+
+        self.assertEqual(len(pages), 3)
+        self.assertTrue(all(['rvprop=ids&' in url for url, headers in StaticTransport.requests]))
+        self.assertEqual([page.updated for page in Wikipage.objects.order_by('id')], updated)
+
+
+@override_settings(WIKIMEDIA_TRANSPORT='wikimedia.tests.StaticTransport', WIKIMEDIA_USE_API=False)
+class WikipageFetchTestCase(TestCase):
+
+    fixtures = ['initial_data']
+
+    def test_save(self):
+        '''Test of fetching content of page on saving depending on settings'''
+        StaticTransport.responses = [('en.wikipedia.org', 200, '<p>Fetched</p>')]
+        project = Wikipage.objects.get_project('wikipedia')
+
+        page = Wikipage(lang='en', project=project, title='Fetched')
+        page.save()
+        self.assertEqual(page.content, '<p>Fetched</p>')
+
+        StaticTransport.responses = []
+        page.object_id = 1
+        page.save(update_fields=['object_id'])
+
+        StaticTransport.responses = [('en.wikipedia.org', 200, '<p>Fetched again</p>')]
+        page.save(update_fields=None)
+        self.assertEqual(Wikipage.objects.get(id=page.id).content, '<p>Fetched again</p>')
+        StaticTransport.responses = []
+
+        with self.settings(WIKIMEDIA_FETCH_ON_SAVE=False):
+            page = Wikipage(lang='en', project=project, title='Saved')
+            page.save()
+            self.assertEqual(Wikipage.objects.get(id=page.id).content, '')
+            self.assertRaises(urllib2.HTTPError, page.refresh)
+
+        with self.settings(WIKIMEDIA_FETCH_ON_SAVE='defer'):
+            page = Wikipage(lang='en', project=project, title='Deferred')
+            page.save()
+            self.assertEqual(Wikipage.objects.get(id=page.id).content, '')
+
+        StaticTransport.responses = [('en.wikipedia.org', 200, '<p>Refreshed</p>')]
+        self.assertTrue(page.refresh())
+        self.assertEqual(Wikipage.objects.get(id=page.id).content, '<p>Refreshed</p>')
+
+    def test_executor(self):
+        '''Test of coalescing tasks and limiting running tasks per domain in thread pool executor'''
+        release = threading.Event()
+        running = []
+
+        class Executor(tasks.ThreadPoolExecutor):
+            def run(self, task):
+                running.append(task.key[:3])
+                release.wait(5)
+                if task.key[2] == 'Error':
+                    raise ValueError(task.key[2])
+                return task.key[2]
+
+        with self.settings(WIKIMEDIA_TASK_WORKERS=4, WIKIMEDIA_TASK_DOMAIN_LIMIT=1):
+            executor = Executor()
+        futures = [executor.submit(tasks.Task(title, 'en', 'wikipedia', 'en.wikipedia.org'))
+                   for title in ['Page', 'Page', 'Error']]
+        futures += [executor.submit(tasks.Task('Page', 'en', 'wikiquote', 'en.wikiquote.org'))]
+        self.assertTrue(futures[0] is futures[1])
+
+        time.sleep(0.1)
+        self.assertEqual(sorted(running), [('wikipedia', 'en', 'Page'), ('wikiquote', 'en', 'Page')])
+        self.assertEqual(futures[2].status, 'pending')
+        self.assertRaises(tasks.TaskTimeoutError, futures[0].result, 0.01)
+
+        release.set()
+        self.assertEqual(futures[0].result(5), 'Page')
+        self.assertTrue(isinstance(futures[2].exception(5), ValueError))
+        self.assertEqual(futures[3].result(5), 'Page')
+
+        # tasks with other object or with_sister_projects are not coalesced
+        release.clear()
+        futures = [executor.submit(tasks.Task('Page', 'en', 'wikipedia', 'en.wikipedia.org', **kwargs))
+                   for kwargs in [{}, {'content_type_id': 1, 'object_id': 1}, {'content_type_id': 1, 'object_id': 2},
+                                  {'with_sister_projects': True}, {'content_type_id': 1, 'object_id': 1}]]
+        self.assertEqual(len(set([id(future) for future in futures])), 4)
+        self.assertTrue(futures[1] is futures[4])
+        release.set()
+        self.assertTrue(all([future.result(5) == 'Page' for future in futures]))
+
+    def test_queue_executor(self):
+        '''Test of coalescing tasks sent to external queue'''
+        queue = []
+
+        class Executor(tasks.QueueExecutor):
+            def enqueue(self, payload):
+                queue.append(payload)
+                return len(queue)
+
+        executor = Executor()
+        task = tasks.Task(u'Страница', 'ru', 'wikipedia', 'ru.wikipedia.org')
+        tasks.get_task_cache().delete(tasks.get_task_cache_key(task.payload))
+        self.assertEqual(executor.submit(task).task_id, 1)
+        self.assertEqual(executor.submit(task).task_id, None)
+        self.assertEqual(len(queue), 1)
+
+        # task started by worker of queue
+        tasks.get_task_cache().delete(tasks.get_task_cache_key(task.payload))
+        self.assertEqual(executor.submit(task).status, 'queued')
+        self.assertEqual(len(queue), 2)
+
+        # the same page for other object is queued too
+        task = tasks.Task(u'Страница', 'ru', 'wikipedia', 'ru.wikipedia.org', content_type_id=1, object_id=1)
+        self.assertEqual(executor.submit(task).task_id, 3)
+        self.assertEqual(queue[-1]['object_id'], 1)
+
+
+class RateLimiterTestCase(TestCase):
+
+    def test_rate_limiter(self):
+        '''Test of limiting rate of requests per domain with token bucket'''
+        limiter = RateLimiter(rate=20, burst=2)
+        start = time.time()
+        for i in range(4):
+            limiter.acquire('en.wikipedia.org')
+        limiter.acquire('ru.wikipedia.org')
+        self.assertTrue(0.1 <= time.time() - start < 0.2)
+
+        limiter.block('ru.wikipedia.org', 0.1)
+        start = time.time()
+        limiter.acquire('ru.wikipedia.org')
+        self.assertTrue(time.time() - start >= 0.1)
+
+        self.assertEqual(parse_retry_after('5'), 5)
+        self.assertEqual(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+        self.assertEqual(parse_retry_after('unknown'), None)
+
+    def test_file_rate_limiter(self):
+        '''Test of sharing rate limits through files'''
+        directory = tempfile.mkdtemp()
+        try:
+            limiters = [FileRateLimiter(directory, rate=20, burst=1) for i in range(2)]
+            start = time.time()
+            for i in range(3):
+                limiters[i % 2].acquire('en.wikipedia.org')
+            self.assertTrue(time.time() - start >= 0.1)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_retry_after(self):
+        '''Test of repeating request after time of Retry-After header'''
+        responses = [(429, 'Too Many Requests', {'retry-after': '0.1'}, ''), (200, 'OK', {}, 'Content')]
+
+        class Transport(BaseTransport):
+            def _request(self, url, headers):
+                return responses.pop(0)
+
+        start = time.time()
+        with self.settings(WIKIMEDIA_RETRY_BACKOFF=0):
+            response = Transport().open(urllib2.Request('http://en.wikipedia.org/wiki/Page'))
+        self.assertEqual(response.content, 'Content')
+        self.assertTrue(time.time() - start >= 0.1)
+
+
+class BenchmarkTestCase(TestCase):
+
+    fixtures = ['initial_data']
+
+    def test_benchmark(self):
+        '''Test of running benchmark with stub server'''
+        corpus = benchmark.load_corpus(sizes=(1,))
+        results = benchmark.benchmark(corpus, parsers=benchmark.PARSERS[:1], isolate=False)
+        self.assertEqual(len(results), len(benchmark.TRANSPORTS))
+        for parser, transport, result in results:
+            self.assertEqual(result['pages'], len(corpus))
+            for stage in benchmark.STAGES:
+                self.assertEqual(len(result['times'][stage]), len(corpus))
+        self.assertFalse(Wikiproject.objects.filter(code=benchmark.PROJECT_CODE).exists())
+
+
+@override_settings(WIKIMEDIA_TRANSPORT='wikimedia.tests.StaticTransport', WIKIMEDIA_USE_API=False,
+                   WIKIMEDIA_METRICS_SINK='wikimedia.metrics.SignalMetricsSink')
+class MetricsTestCase(TestCase):
+
+    fixtures = ['initial_data']
+
+    def test_metrics(self):
+        '''Test of measuring fetching, parsing and saving of page'''
+        measurements = []
+
+        def receiver(name, kind, value, tags, **kwargs):
+            measurements.append((name, kind, value, tags))
+
+        with open(os.path.join(TESTDATA_DIR, 'en_easy_rider.html')) as f:
+            StaticTransport.responses = [('en.wikipedia.org', 200, f.read())]
+
+        metrics.metric.connect(receiver)
+        try:
+            Wikipage(lang='en', project=Wikipage.objects.get_project('wikipedia'), title='Easy_Rider').save()
+        finally:
+            metrics.metric.disconnect(receiver)
+
+        names = set([name for name, kind, value, tags in measurements])
+        self.assertEqual(names, set(['wikimedia.fetch', 'wikimedia.fetch.bytes', 'wikimedia.process',
+                                     'wikimedia.parse_content', 'wikimedia.remove_garbage',
+                                     'wikimedia.remove_garbage.removed', 'wikimedia.save']))
+        removed = dict((tags['rule'], value) for name, kind, value, tags in measurements
+                       if name == 'wikimedia.remove_garbage.removed')
+        self.assertEqual(removed['infobox'], 1)
+        self.assertEqual(removed['span[class=editsection]'], 1)
+        self.assertEqual(removed['block'], 8)
+        self.assertTrue(all([tags['domain'] == 'en.wikipedia.org' for name, kind, value, tags in measurements]))
+
+        with self.settings(WIKIMEDIA_METRICS_SINK=None):
+            self.assertEqual(metrics.get_sink(), None)
+
+
+@override_settings(WIKIMEDIA_TRANSPORT='wikimedia.tests.StaticTransport', WIKIMEDIA_USE_API=False)
+class ResponseStoreTestCase(TestCase):
+
+    fixtures = ['initial_data']
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_store(self):
+        '''Test of storing raw responses by url and revision'''
+        store = ResponseStore(self.directory)
+        self.assertEqual(store.get('http://example.com/'), None)
+
+        digest = store.put('http://example.com/', u'<p>Первая</p>', 1, {'etag': '"1"'})
+        self.assertEqual(store.put('http://example.org/', u'<p>Первая</p>'), digest)
+        store.put('http://example.com/', '<p>Second</p>', 2)
+
+        response = store.get('http://example.com/')
+        self.assertEqual((response.content, response.revision), ('<p>Second</p>', 2))
+        response = store.get('http://example.com/', 1)
+        self.assertEqual((response.content, response.revision, response.headers),
+                         (u'<p>Первая</p>', 1, {'etag': '"1"'}))
+        self.assertTrue(isinstance(response.content, unicode))
+        self.assertTrue('http://example.org/' in store)
+        self.assertEqual(len(os.listdir(os.path.join(self.directory, 'objects'))), 2)
+
+    def test_reparse(self):
+        '''Test of replaying stored responses and reparsing them without network'''
+        with open(os.path.join(TESTDATA_DIR, 'en_easy_rider.html')) as f:
+            raw = f.read()
+        StaticTransport.responses = [('en.wikipedia.org', 200, raw)]
+
+        with self.settings(WIKIMEDIA_RESPONSE_STORE=self.directory):
+            page = Wikipage(lang='en', project=Wikipage.objects.get_project('wikipedia'), title='Easy_Rider')
+            page.save()
+            content = page.content
+            self.assertEqual(ResponseStore(self.directory).get(page.get_url()).content, raw)
+
+            StaticTransport.responses = []
+            with self.settings(WIKIMEDIA_RESPONSE_STORE_REPLAY=True):
+                self.assertTrue(page.refresh())
+            self.assertEqual(Wikipage.objects.get(id=page.id).content, content)
+
+            Wikipage.objects.filter(id=page.id).update(content='<p>Broken</p>', structure='')
+            Wikipage(lang='en', project=page.project, title='Not_stored').save(fetch=False)
+            out = StringIO.StringIO()
+            call_command('reparse_wikipages', processes=1, stdout=out)
+            self.assertEqual(out.getvalue().strip().split('\n')[-1],
+                             'Reparsed 1 wikipages, 1 without stored response')
+
+        page = Wikipage.objects.get(id=page.id)
+        self.assertEqual(page.content, content)
+        self.assertEqual(page.get_sections(), [(u'Plot', 2), (u'Legacy', 2)])
+
+    def test_reparse_db(self):
+        '''Test of reparsing current content of pages by chunks with resuming'''
+        with open(os.path.join(TESTDATA_DIR, 'en_easy_rider.html')) as f:
+            raw = f.read()
+        project = Wikipage.objects.get_project('wikipedia')
+        ids = []
+        for title in ['First', 'Second', 'Third']:
+            page = Wikipage(lang='en', project=project, title=title, content=raw)
+            page.save(fetch=False)
+            ids += [page.id]
+        updated = Wikipage.objects.get(id=ids[1]).updated
+
+        checkpoint = os.path.join(self.directory, 'checkpoint.json')
+        with open(checkpoint, 'w') as f:
+            json.dump({'last_id': ids[0]}, f)
+
+        out = StringIO.StringIO()
+        call_command('reparse_wikipages', source='db', processes=2, chunk_size=1, checkpoint=checkpoint, stdout=out)
+        self.assertEqual(out.getvalue().strip().split('\n'), [
+            'Processed 1 of 2 wikipages',
+            'Processed 2 of 2 wikipages',
+            'Reparsed 2 wikipages, 0 without stored response',
+        ])
+        with open(checkpoint) as f:
+            self.assertEqual(json.load(f), {'last_id': ids[2]})
+
+        pages = Wikipage.objects.in_bulk(ids)
+        self.assertEqual(pages[ids[0]].content, raw)
+        self.assertEqual(pages[ids[0]].structure, '')
+        self.assertTrue(len(pages[ids[1]].content) < len(raw))
+        self.assertEqual(pages[ids[1]].get_sections(), [(u'Plot', 2), (u'Legacy', 2)])
+        self.assertEqual(pages[ids[1]].updated, updated)
+        self.assertEqual(pages[ids[2]].content, pages[ids[1]].content)
+
+    def test_reparse_db_keeps_links(self):
+        '''Test of keeping sister projects and images of processed pages reparsed from DB'''
+        project = Wikipage.objects.get_project('wikipedia')
+        ids = []
+        for name in ['ru_easy_rider.html', 'en_easy_rider.html']:
+            with open(os.path.join(TESTDATA_DIR, name)) as f:
+                page = Wikipage(lang=name[:2], project=project, title='Easy_Rider', content=f.read())
+            page.process_content()
+            page.save(fetch=False)
+            ids += [page.id]
+        structures = [Wikipage.objects.get(id=id).get_structure() for id in ids]
+        self.assertEqual(structures[0]['sister_projects'], [[u'wikiquote', u'Беспечный_ездок']])
+        self.assertEqual(len(structures[1]['images']), 2)
+        links = list(WikipageSisterLink.objects.values_list('page', 'project', 'title', 'position'))
+        self.assertEqual(len(links), 3)
+
+        call_command('reparse_wikipages', source='db', processes=1, stdout=StringIO.StringIO())
+
+        self.assertEqual(list(WikipageSisterLink.objects.values_list('page', 'project', 'title', 'position')), links)
+        self.assertEqual(Wikipage.objects.get(id=ids[0]).sister_projects, [(u'wikiquote', u'Беспечный_ездок')])
+        for id, page_structure in zip(ids, structures):
+            reparsed = Wikipage.objects.get(id=id).get_structure()
+            self.assertEqual(reparsed['sister_projects'], page_structure['sister_projects'])
+            self.assertEqual(reparsed['images'], page_structure['images'])
+            self.assertEqual([section[:2] for section in reparsed['sections']],
+                             [section[:2] for section in page_structure['sections']])
+
+
+class WikipageStructureTestCase(TestCase):
+
+    fixtures = ['initial_data']
+
+    def test_structure(self):
+        '''Test of extracting and storing structure of content'''
+        with open(os.path.join(TESTDATA_DIR, 'ru_easy_rider.html')) as f:
+            content = f.read()
+        project = Wikipage.objects.get_project('wikipedia')
+        page = Wikipage(lang='ru', project=project, title=u'Беспечный_ездок', content=content)
+        page.process_content()
+        page.save(fetch=False)
+
+        self.assertEqual(Wikipage(lang='ru', project=project, title=u'Другая').images, [])
+
+        page = Wikipage.objects.defer('content').get(id=page.id)
+        self.assertEqual(page.get_sections(), [(u'Сюжет', 2)])
+        self.assertEqual(page.images, page.get_images())
+        self.assertEqual(page.get_links(), [u'Хоппер,_Деннис'])
+        self.assertEqual(page.get_structure()['sister_projects'], [[u'wikiquote', u'Беспечный_ездок']])
+
+        with self.assertNumQueries(1):
+            section = page.get_section(u'Сюжет')
+        self.assertTrue(section.startswith(u'<h2>') and section.find(u'Сюжет') != -1)
+        self.assertTrue(page.get_section(None).find(u'художественный фильм') != -1)
+        self.assertEqual(page.get_section(u'Unknown'), None)
+        self.assertEqual(page.content[len(page.get_section(None)):].find(section), 0)
+
+        with self.settings(WIKIMEDIA_COMPRESS_CONTENT=True):
+            page.save(fetch=False)
+        page = Wikipage.objects.defer('content').get(id=page.id)
+        self.assertEqual(page.get_section(u'Сюжет'), section)
+
+
+class WikipageBulkSaveTestCase(TestCase):
+
+    fixtures = ['initial_data']
+
+    def bulk_save(self):
+        '''Write new and existing pages of object and delete stale pages'''
+        project = Wikipage.objects.get_project('wikipedia')
+        object = Wikipage(lang='en', project=project, title='Object', content='Object')
+        object.save(fetch=False)
+        content_type = ContentType.objects.get_for_model(object)
+
+        existing = Wikipage(lang='en', project=project, title='Existing', content='<p>Old</p>',
+                            content_type=content_type, object_id=object.id)
+        existing.save(fetch=False)
+        stale = Wikipage(lang='en', project=project, title='Stale', content='<p>Stale</p>',
+                         content_type=content_type, object_id=object.id)
+        stale.save(fetch=False)
+
+        pages = [
+            Wikipage(lang='en', project=project, title='Existing', content='<p>New</p>',
+                     content_type=content_type, object_id=object.id),
+            Wikipage(lang='en', project=project, title='New', content='<p>New</p>'),
+            Wikipage(lang='ru', project=project, title='New', content=u'<p>Новая</p>'),
+        ]
+        pages[1].sister_projects = [('wikiquote', 'New')]
+        with self.settings(WIKIMEDIA_COMPRESS_CONTENT=True):
+            saved = Wikipage.objects.bulk_save(pages + [pages[1]], delete_stale=True)
+
+        self.assertEqual(len(saved), 3)
+        self.assertEqual(pages[0].id, existing.id)
+        self.assertEqual(len(set([page.id for page in pages])), 3)
+        self.assertFalse(Wikipage.objects.filter(id=stale.id).exists())
+        self.assertEqual(Wikipage.objects.get(id=existing.id).content, '<p>New</p>')
+        self.assertTrue(Wikipage.objects.filter(id=existing.id, content__startswith=COMPRESSED_PREFIX).exists())
+        self.assertTrue(Wikipage.objects.get(id=existing.id).updated > existing.updated)
+        self.assertEqual(Wikipage.objects.get(id=pages[2].id).content, u'<p>Новая</p>')
+        self.assertEqual(Wikipage.objects.get(id=pages[1].id).sister_projects, [(u'wikiquote', u'New')])
+        self.assertEqual(Wikipage.objects.count(), 4)
+
+    def test_bulk_save(self):
+        '''Test of writing pages with bulk upsert'''
+        if not Wikipage.objects._supports_upsert():
+            raise unittest.SkipTest('DB does not support INSERT ... ON CONFLICT')
+        self.bulk_save()
+
+    def test_bulk_save_without_upsert(self):
+        '''Test of writing pages with bulk insert and updates'''
+        Wikipage.objects._supports_upsert = lambda: False
+        try:
+            self.bulk_save()
+        finally:
+            del Wikipage.objects._supports_upsert
+
+
+class WikipageSisterLinkTestCase(TestCase):
+
+    fixtures = ['initial_data']
+
+    def test_sister_links(self):
+        '''Test of persisting links to sister projects found by parser'''
+        with open(os.path.join(TESTDATA_DIR, 'ru_easy_rider.html')) as f:
+            content = f.read()
+        project = Wikipage.objects.get_project('wikipedia')
+        page = Wikipage(lang='ru', project=project, title=u'Беспечный_ездок', content=content)
+        page.process_content()
+        page.save(fetch=False)
+
+        page = Wikipage.objects.get(id=page.id)
+        with self.assertNumQueries(1):
+            self.assertEqual(page.sister_projects, [(u'wikiquote', u'Беспечный_ездок')])
+            self.assertEqual(page.sister_projects, [(u'wikiquote', u'Беспечный_ездок')])
+
+        other = Wikipage(lang='en', project=project, title='Easy_Rider', content='<p></p>')
+        other.save(fetch=False)
+        pages = list(Wikipage.objects.filter(id__in=[page.id, other.id]).order_by('id'))
+        with self.assertNumQueries(1):
+            WikipageSisterLink.objects.prefetch(pages)
+            self.assertEqual([p.sister_projects for p in pages], [[(u'wikiquote', u'Беспечный_ездок')], []])
+
+        self.assertEqual(list(WikipageSisterLink.objects.get_linking_pages('wikiquote', [u'Беспечный_ездок'])),
+                         [page])
+
+        page.sister_projects = [('wikiquote', u'Ездок'), ('wikiquote', u'Ездок'), ('wikicommons', u'Ездок')]
+        page.save(fetch=False)
+        self.assertEqual(Wikipage.objects.get(id=page.id).sister_projects,
+                         [(u'wikiquote', u'Ездок'), (u'wikicommons', u'Ездок')])
+
+        page.delete()
+        self.assertEqual(WikipageSisterLink.objects.count(), 0)
+
+
+class WikiprojectRegistryTestCase(TestCase):
+
+    fixtures = ['initial_data']
+
+    def test_registry(self):
+        '''Test of getting projects from registry without queries'''
+        Wikiproject.objects.get_registry()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(Wikipage.objects.get_project('wikiquote').code, 'wikiquote')
+            self.assertEqual(Wikiproject.objects.get_by_domain('ru.wikiquote.org', 'ru').code, 'wikiquote')
+            self.assertEqual(Wikiproject.objects.get_by_domain('commons.wikimedia.org', 'ru').code, 'wikicommons')
+            self.assertEqual(Wikiproject.objects.get_by_domain('ru.wikiquote.org', 'en'), None)
+            self.assertEqual(Wikiproject.objects.get_by_domain('example.com', 'en'), None)
+            self.assertRaises(ValueError, Wikipage.objects.get_project, 'wikiunknown')
+
+        Wikiproject.objects.create(code='wikiunknown', domain='unknown.org')
+        self.assertEqual(Wikipage.objects.get_project('wikiunknown').code, 'wikiunknown')
+        self.assertEqual(Wikiproject.objects.get_by_domain('unknown.org', 'en').code, 'wikiunknown')
+
+        Wikiproject.objects.get(code='wikiunknown').delete()
+        self.assertRaises(ValueError, Wikipage.objects.get_project, 'wikiunknown')
+
+
+class WikipageAttributesTestCase(TestCase):
+
+    fixtures = ['initial_data']
+
+    def test_attributes(self):
+        '''Test of getting content of wikipages as attributes of manager'''
+        project = Wikipage.objects.get_project('wikipedia')
+        page = Wikipage(lang='en', project=project, title='Easy_Rider', content='<p>Easy Rider</p>')
+        page.save(fetch=False)
+        Wikipage(lang='ru', project=project, title='Easy_Rider', content='<p>Ru</p>', object_id=page.id,
+                 content_type=ContentType.objects.get_for_model(page)).save(fetch=False)
+
+        # manager of related object with cache of pages
+        manager = Wikipage.objects.for_object(page)
+        with self.assertNumQueries(1):
+            self.assertEqual(manager.wikipedia_ru, '<p>Ru</p>')
+            self.assertEqual(manager.wikipedia_en, '')
+            self.assertEqual(manager.wikiquote_ru, '')
+
+        clear_wikipages_cache(page)
+        with self.assertNumQueries(1):
+            self.assertEqual(Wikipage.objects.wikipedia_en, '<p>Easy Rider</p>')
+
+        self.assertRaises(AttributeError, getattr, Wikipage.objects, 'wikipedia_de')
+        self.assertRaises(AttributeError, getattr, Wikipage.objects, 'wikiunknown_en')
+        self.assertRaises(AttributeError, getattr, Wikipage.objects, '_wikipedia_en')
+
+    def test_prefetch(self):
+        '''Test of loading wikipages of many objects at once'''
+        project = Wikipage.objects.get_project('wikipedia')
+        objects = []
+        for i in range(3):
+            object = Wikipage(lang='en', project=project, title='Object_%d' % i, content='Object')
+            object.save(fetch=False)
+            objects += [object]
+            for lang in ['en', 'ru']:
+                Wikipage(lang=lang, project=project, title='Page_%d' % i, content='<p>%s %d</p>' % (lang, i),
+                         object_id=object.id, content_type=ContentType.objects.get_for_model(object)).save(fetch=False)
+
+        # query of objects and query of their wikipages
+        with self.assertNumQueries(2):
+            objects = prefetch_wikipages(Wikipage.objects.filter(title__startswith='Object_').order_by('id'),
+                                         fields=['title'])
+
+        with self.assertNumQueries(0):
+            for object in objects:
+                i = int(object.title.split('_')[1])
+                self.assertEqual(Wikipage.objects.for_object(object).get_page('wikipedia', 'ru').title, 'Page_%d' % i)
+                self.assertEqual(Wikipage.objects.for_object(object).wikiquote_en, '')
+
+        # deferred content is loaded on access
+        with self.assertNumQueries(1):
+            self.assertEqual(Wikipage.objects.for_object(objects[0]).wikipedia_en, '<p>en 0</p>')
+
+        with self.assertNumQueries(1):
+            objects = prefetch_wikipages(objects, langs=['ru'])
+        with self.assertNumQueries(0):
+            self.assertEqual(Wikipage.objects.for_object(objects[0]).wikipedia_ru, '<p>ru 0</p>')
+            self.assertEqual(Wikipage.objects.for_object(objects[0]).wikipedia_en, '')
+
+
+@override_settings(WIKIMEDIA_CACHE='wikimedia',
+                   CACHES={'wikimedia': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class WikipageCacheTestCase(TestCase):
+
+    fixtures = ['initial_data']
+
+    def test_cache(self):
+        '''Test of serving content of wikipages from cache backend'''
+        cache.reset_stats()
+        project = Wikipage.objects.get_project('wikipedia')
+        object = Wikipage(lang='en', project=project, title='Object', content='Object')
+        object.save(fetch=False)
+        page = Wikipage(lang='ru', project=project, title='Page', content='<p>Ru</p>', object_id=object.id,
+                        content_type=ContentType.objects.get_for_model(object))
+        page.save(fetch=False)
+
+        def get_content(name):
+            # per-object cache of pages is served before cache backend
+            clear_wikipages_cache(object)
+            return getattr(Wikipage.objects.for_object(object), name)
+
+        with self.assertNumQueries(2):
+            self.assertEqual(get_content('wikipedia_ru'), '<p>Ru</p>')
+            self.assertEqual(get_content('wikiquote_ru'), '')
+        with self.assertNumQueries(0):
+            self.assertEqual(get_content('wikipedia_ru'), '<p>Ru</p>')
+            self.assertEqual(get_content('wikiquote_ru'), '')
+        self.assertEqual(cache.get_stats(), {'hits': 2, 'misses': 2})
+
+        # saving and deleting of page invalidate cached content
+        page.content = '<p>New</p>'
+        page.save(fetch=False)
+        self.assertEqual(get_content('wikipedia_ru'), '<p>New</p>')
+        page.delete()
+        self.assertEqual(get_content('wikipedia_ru'), '')
+
+
+class WikipageCompressedContentTestCase(TestCase):
+
+    fixtures = ['initial_data']
+
+    def get_raw_content(self, page):
+        return Wikipage.objects.filter(id=page.id).extra(select={'raw': 'content'}).values_list('raw', flat=True)[0]
+
+    def test_compressed_content(self):
+        '''Test of storing content of wikipages compressed'''
+        project = Wikipage.objects.get_project('wikipedia')
+        content = u'<p>Беспечный ездок</p>' * 100
+        plain = Wikipage(lang='ru', project=project, title='Plain', content=content)
+        plain.save(fetch=False)
+
+        with self.settings(WIKIMEDIA_COMPRESS_CONTENT=True):
+            page = Wikipage(lang='ru', project=project, title='Compressed', content=content)
+            page.save(fetch=False)
+            raw = self.get_raw_content(page)
+            self.assertTrue(raw.startswith(COMPRESSED_PREFIX))
+            self.assertTrue(len(raw) * 5 < len(content))
+            self.assertEqual(Wikipage.objects.get(id=page.id).content, content)
+
+            call_command('compress_wikipages', stdout=StringIO.StringIO())
+            self.assertTrue(self.get_raw_content(plain).startswith(COMPRESSED_PREFIX))
+            self.assertEqual(Wikipage.objects.get(id=plain.id).content, content)
+
+        call_command('compress_wikipages', stdout=StringIO.StringIO())
+        self.assertEqual(self.get_raw_content(plain), content)
+        self.assertEqual(self.get_raw_content(page), content)
+
+    def test_byte_string_content(self):
+        '''Test of saving raw content as byte string with non-ASCII characters'''
+        project = Wikipage.objects.get_project('wikipedia')
+        content = u'<p>Беспечный ездок</p>'
+        field = Wikipage._meta.get_field('content')
+        self.assertEqual(field.get_prep_value(content.encode('utf-8')), content)
+
+        page = Wikipage(lang='ru', project=project, title='Plain', content=content.encode('utf-8'))
+        page.save(fetch=False)
+        self.assertEqual(Wikipage.objects.get(id=page.id).content, content)
+
+        with self.settings(WIKIMEDIA_COMPRESS_CONTENT=True):
+            self.assertTrue(field.get_prep_value(content.encode('utf-8')).startswith(COMPRESSED_PREFIX))
+            page = Wikipage(lang='ru', project=project, title='Compressed', content=content.encode('utf-8'))
+            page.save(fetch=False)
+            self.assertTrue(self.get_raw_content(page).startswith(COMPRESSED_PREFIX))
+            self.assertEqual(Wikipage.objects.get(id=page.id).content, content)
+
+
+class WikimediaParserTestMixin(object):
+
+    fixtures = ['initial_data']
+    pages = ['en_easy_rider.html', 'ru_easy_rider.html']
+
+    def get_page(self, name):
+        return Wikipage(lang=name[:2], project=Wikiproject.objects.get(code='wikipedia'), title='Easy_Rider')
+
+    def get_content(self, name):
+        return open(os.path.join(TESTDATA_DIR, name)).read()
+
+
+class WikimediaParserTestCase(WikimediaParserTestMixin, TestCase):
+
+    def test_garbage_rules(self):
+        '''Test of compiling garbage rules once without changing Remove settings'''
+        parser = WikipageParserBeautifulsoup()
+        content1 = parser.process_content(self.get_content('en_easy_rider.html'), self.get_page('en'))
+        content2 = parser.process_content(self.get_content('en_easy_rider.html'), self.get_page('en'))
+
+        self.assertEqual(content1, content2)
+        self.assertEqual(parser.Remove.block_titles, [])
+        self.assertEqual(parser.Remove.table_classes, [])
+        self.assertEqual(parser.Remove.div_classes, [])
+        self.assertEqual(parser.Remove.span_classes, [])
+        self.assertTrue(parser.rules is WikipageGarbageRules.compile(parser.Remove))
+        self.assertRaises(AttributeError, setattr, parser.rules, 'comments', False)
+
+    def test_shared_parser(self):
+        '''Test of using one parser instance from many threads'''
+        parser = get_parser()
+        self.assertTrue(parser is get_parser())
+        with self.settings(WIKIMEDIA_PARSER='wikimedia.parsers.WikipageParserBase'):
+            self.assertTrue(isinstance(get_parser(), WikipageParserBase))
+
+        # pages without language of sister projects parsing do not query DB from threads
+        page = Wikipage(lang='de', project=Wikiproject.objects.get(code='wikipedia'), title='Easy_Rider')
+        contents = dict((name, parser.process_content(self.get_content(name), page)) for name in self.pages)
+        results = ThreadPool(4).map(lambda name: (name, parser.process_content(self.get_content(name), page)),
+                                    self.pages * 10)
+        for name, content in results:
+            self.assertEqual(content, contents[name])
+        self.assertEqual(parser.content, None)
+
+
+@unittest.skipIf(etree is None, 'lxml is not installed')
+class WikimediaParserLxmlTestCase(WikimediaParserTestMixin, TestCase):
+
+    '''
+    Test of equivalence of lxml and BeautifulSoup parsers on hand-written pages of testdata
+    '''
+
+    def normalize(self, content):
+        '''
+        Return text and sequence of tags with attributes of html independent from serialization.
+        lxml percent-encodes non-ASCII characters of hrefs, so hrefs are compared unquoted
+        '''
+        tags = []
+        for name, attributes in re.findall(r'<(\w+)([^>]*)>', content):
+            attributes = sorted(re.findall(r'([\w-]+)="([^"]*)"', attributes))
+            tags += [(name, [(key, urllib.unquote(value.encode('utf-8')).decode('utf-8') if key == 'href' else value)
+                             for key, value in attributes])]
+        return re.sub(r'\s+', ' ', re.sub(r'<[^>]+>', ' ', content)).strip(), tags
+
+    def test_process_content(self):
+        for name in self.pages:
+            page1, page2 = self.get_page(name), self.get_page(name)
+            content1 = WikipageParserBeautifulsoup().process_content(self.get_content(name), page1)
+            content2 = WikipageParserLxml().process_content(self.get_content(name), page2)
+
+            self.assertEqual(self.normalize(content1), self.normalize(content2))
+            self.assertEqual(page1.sister_projects, page2.sister_projects)
+            self.assertTrue(content2.find(u'Easy Rider') != -1)
+            self.assertTrue(content2.find(u'class="') == -1)
+            self.assertTrue(content2.find(u'style="') == -1)
+            self.assertTrue(content2.find(u'<script') == -1)
+            self.assertTrue(content2.find(u'<!--') == -1)
+
+        self.assertEqual(page2.sister_projects, [('wikiquote', u'Беспечный_ездок')])
+
+    def test_removing_garbage(self):
+        en = WikipageParserLxml().process_content(self.get_content('en_easy_rider.html'), self.get_page('en'))
+        ru = WikipageParserLxml().process_content(self.get_content('ru_easy_rider.html'), self.get_page('ru'))
+
+        self.assertTrue(en.find(u'disambiguation') == -1)
+        self.assertTrue(ru.find(u'другие значения') == -1)
+        self.assertTrue(en.find(u'Original poster') == -1)
+        self.assertTrue(ru.find(u'Постер фильма') == -1)
+        self.assertTrue(en.find(u'<h2>Contents</h2>') == -1)
+        self.assertTrue(en.find(u'Edit section') == -1)
+        self.assertTrue(en.find(u'metadata mbox-small plainlinks') == -1)
+        self.assertTrue(en.find(u'References') == -1)
+        self.assertTrue(en.find(u'Internet Movie Database. Box office/Business for') == -1)
+        self.assertTrue(en.find(u'See also') == -1)
+        self.assertTrue(en.find(u'Films directed by') == -1)
+        self.assertTrue(en.find(u'National Film Registry') != -1)
+        self.assertTrue(ru.find(u'Ссылки') == -1)
+        self.assertTrue(ru.find(u'allmovie') == -1)
+        self.assertTrue(ru.find(u'Примечания') == -1)
+        self.assertTrue(ru.find(u'The Road Movie Book') == -1)
+        self.assertTrue(ru.find(u'См. также') == -1)
+        self.assertTrue(ru.find(u'ogg_player_1') == -1)
+        self.assertTrue(ru.find(u'По словам режиссёра') != -1)
+
+    def test_wikicommons_images(self):
+        import lxml.html
+        content = self.get_content('en_easy_rider.html')
+
+        parser1 = WikipageParserBeautifulsoup()
+        parser1.content = BeautifulSoup(content)
+        parser2 = WikipageParserLxml()
+        parser2.content = lxml.html.fragment_fromstring(content.decode('utf-8'), create_parent='div')
+
+        self.assertEqual(parser1.parse_wikicommons_images(), parser2.parse_wikicommons_images())
+        self.assertEqual(parser2.parse_wikicommons_images(), [
+            ('http://upload.wikimedia.org/wikipedia/commons/4/45/Bike_1.jpg', u'First bike'),
+            ('http://upload.wikimedia.org/wikipedia/commons/b/b2/Bike_2.jpg', u'<i>Second</i>'),
+        ])
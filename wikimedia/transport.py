@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+from importlib import import_module
+import httplib
+import socket
+import threading
+import time
+import urllib2
+import urlparse
+import zlib
+
+from django.core.exceptions import ImproperlyConfigured
+
+from metrics import get_sink
+from ratelimit import get_rate_limiter, parse_retry_after
+
+try:
+    # Django 1.8
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
+
+__all__ = ['TransportResponse', 'BaseTransport', 'UrllibTransport', 'PooledTransport', 'get_transport']
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport():
+    '''
+    Return shared instance of transport defined in settings.WIKIMEDIA_TRANSPORT
+    '''
+    from django.conf import settings
+    transport = getattr(settings, 'WIKIMEDIA_TRANSPORT', 'wikimedia.transport.PooledTransport')
+    if transport not in _transports:
+        with _transports_lock:
+            if transport not in _transports:
+                try:
+                    transport_path = transport.split('.')
+                    transport_module = import_module('.'.join(transport_path[:-1]))
+                    Transport = getattr(transport_module, transport_path[-1])
+                except (ImportError, AttributeError), e:
+                    raise ImproperlyConfigured('Error importing wikipage transport %s: "%s"' % (transport, e))
+                _transports[transport] = Transport()
+
+    return _transports[transport]
+
+
+def clear_transport_cache(setting=None, **kwargs):
+    if setting is None or setting.startswith('WIKIMEDIA_'):
+        with _transports_lock:
+            _transports.clear()
+
+setting_changed.connect(clear_transport_cache)
+
+
+class TransportResponse(object):
+
+    '''
+    Decoded response of transport, headers names are lowercased
+    '''
+
+    def __init__(self, url, status, headers, content):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.content = content
+
+    def __repr__(self):
+        return '<TransportResponse: %s %s>' % (self.status, self.url)
+
+
+class BaseTransport(object):
+
+    '''
+    Common interface for transports fetching wikimedia pages.
+    Transport negotiates compression, decodes content and retries failed requests with backoff
+    '''
+
+    def __init__(self):
+        from django.conf import settings
+        self.timeout = getattr(settings, 'WIKIMEDIA_TIMEOUT', 30)
+        self.retries = getattr(settings, 'WIKIMEDIA_RETRIES', 3)
+        self.backoff = getattr(settings, 'WIKIMEDIA_RETRY_BACKOFF', 0.5)
+
+    def open(self, request):
+        '''
+        Make request for urllib2.Request instance and return TransportResponse.
+        Response with status 304 returns back, raises urllib2.HTTPError for other error statuses
+        '''
+        url = request.get_full_url()
+        headers = dict(request.header_items())
+        headers['Accept-Encoding'] = 'gzip, deflate'
+
+        sink = get_sink()
+        if sink is not None:
+            start = time.time()
+
+        for redirect in range(MAX_REDIRECTS + 1):
+            status, reason, response_headers, content = self._retry_request(url, headers)
+            if status not in REDIRECT_STATUSES or 'location' not in response_headers:
+                break
+            url = urlparse.urljoin(url, response_headers['location'])
+
+        if sink is not None:
+            domain = urlparse.urlsplit(url).netloc
+            sink.timing('wikimedia.fetch', time.time() - start, domain=domain, status=status)
+            sink.increment('wikimedia.fetch.bytes', len(content or ''), domain=domain, status=status)
+
+        if status >= 400:
+            raise urllib2.HTTPError(url, status, reason, response_headers, None)
+
+        content = self.decode(content, response_headers.get('content-encoding', ''))
+        return TransportResponse(url, status, response_headers, content)
+
+    def _retry_request(self, url, headers):
+        '''
+        Make request retrying connection errors and server errors with exponential backoff.
+        Requests are limited by rate limiter of domain, which is blocked for time of Retry-After header
+        '''
+        domain = urlparse.urlsplit(url).netloc
+        limiter = get_rate_limiter()
+        for attempt in range(self.retries + 1):
+            limiter.acquire(domain)
+            try:
+                status, reason, response_headers, content = self._request(url, headers)
+            except (socket.error, httplib.HTTPException):
+                if attempt == self.retries:
+                    raise
+            else:
+                retry_after = parse_retry_after(response_headers.get('retry-after'))
+                if retry_after and status in RETRY_STATUSES:
+                    limiter.block(domain, retry_after)
+                if status not in RETRY_STATUSES or attempt == self.retries:
+                    break
+            time.sleep(self.backoff * 2 ** attempt)
+
+        return status, reason, response_headers, content
+
+    def decode(self, content, encoding):
+        '''
+        Decompress content with gzip or deflate content encoding
+        '''
+        encoding = encoding.strip().lower()
+        if not content or encoding in ('', 'identity'):
+            return content
+        elif encoding == 'gzip':
+            return zlib.decompress(content, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            try:
+                return zlib.decompress(content)
+            except zlib.error:
+                # raw deflate stream without zlib header
+                return zlib.decompress(content, -zlib.MAX_WBITS)
+        raise ValueError('Unsupported content encoding "%s"' % encoding)
+
+    def _request(self, url, headers):
+        '''
+        Make GET request and return tuple (status, reason, headers, raw content)
+        '''
+        raise NotImplementedError
+
+
+class UrllibTransport(BaseTransport):
+
+    '''
+    Transport based on urllib2, opens new connection for every request
+    '''
+
+    def _request(self, url, headers):
+        try:
+            response = urllib2.urlopen(urllib2.Request(url=url, headers=headers), timeout=self.timeout)
+        except urllib2.HTTPError, e:
+            response = e
+        try:
+            return response.code, response.msg, dict(response.info().items()), response.read()
+        finally:
+            response.close()
+
+
+class PooledTransport(BaseTransport):
+
+    '''
+    Transport keeping persistent HTTP/1.1 connections in pools per host
+    '''
+
+    def __init__(self):
+        from django.conf import settings
+        super(PooledTransport, self).__init__()
+        self.pool_size = getattr(settings, 'WIKIMEDIA_POOL_SIZE', 10)
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _get_connection(self, scheme, host):
+        '''
+        Return tuple (connection, reused), connection is taken from pool of host if there is one
+        '''
+        with self._lock:
+            pool = self._pools.get((scheme, host))
+            if pool:
+                return pool.pop(), True
+        return self._new_connection(scheme, host), False
+
+    def _new_connection(self, scheme, host):
+        connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        return connection_class(host, timeout=self.timeout)
+
+    def _release_connection(self, scheme, host, connection):
+        with self._lock:
+            pool = self._pools.setdefault((scheme, host), [])
+            if len(pool) < self.pool_size:
+                pool.append(connection)
+                return
+        connection.close()
+
+    def _request(self, url, headers):
+        scheme, host, path, query, fragment = urlparse.urlsplit(url)
+        if query:
+            path += '?' + query
+
+        connection, reused = self._get_connection(scheme, host)
+        try:
+            response, content = self._send(connection, path or '/', headers)
+        except socket.timeout:
+            raise
+        except (socket.error, httplib.BadStatusLine):
+            if not reused:
+                raise
+            # connection was closed by server while staying in the pool, request is repeated
+            # at once on a new connection without backoff and attempt of retries
+            connection = self._new_connection(scheme, host)
+            response, content = self._send(connection, path or '/', headers)
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release_connection(scheme, host, connection)
+
+        return response.status, response.reason, dict(response.getheaders()), content
+
+    def _send(self, connection, path, headers):
+        '''
+        Make GET request on connection and return tuple (response, raw content), failed connection is closed
+        '''
+        try:
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            return response, response.read()
+        except:
+            connection.close()
+            raise
+
+    def close(self):
+        '''
+        Close all connections in pools
+        '''
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            for connection in pool:
+                connection.close()